@@ -1,25 +1,132 @@
 # -*- coding: utf-8 -*-
-import os, json
-from datetime import datetime
-from flask import Flask, request, jsonify, send_from_directory, send_file
+import os, io, csv, json, time, base64, hashlib, sqlite3, threading, zlib
+import atexit
+import click
+from datetime import datetime, timedelta
+from flask import (Blueprint, Flask, Response, current_app, g, has_request_context, request, jsonify,
+                   send_from_directory, stream_with_context)
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
+from sqlalchemy import (and_, bindparam, case, event, func, insert, or_, select, text, true, tuple_, union,
+                        update)
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
 from dotenv import load_dotenv
-from io import StringIO, BytesIO
-from models import db, License, ApiKey, Voice, Config, ActivityLog
+from models import db, License, ApiKey, Voice, Config, ActivityLog, CacheVersion, UsageHourly, UsageDaily
+from keypool import ApiKeyPool
+from licensecache import LicenseCache
+from jsonprovider import make_provider
+from ratelimit import DEFAULT_IP_LIMITS, DEFAULT_LIMITS, MemoryBackend, RateLimiter, RedisBackend, parse_limits
+from migrations import run_migrations
+from dbdialect import dialect_insert
+from logwriter import ActivityLogWriter, format_details
+from rollups import apply_rollups, rebuild_rollups
+import changefeed
+import idempotency
+import metrics
 
 load_dotenv()
 
-app = Flask(__name__, static_folder='.')
-CORS(app)
+# Routes and CLI commands live on this blueprint; create_app() wires it into
+# an application. Nothing here touches the database at import time.
+bp = Blueprint("amulet", __name__, cli_group=None)
 
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///amulet.db')
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'secret')
-db.init_app(app)
+def _engine_options(uri):
+    """Pool settings from the environment (DB_POOL_*); pre-ping is on by default."""
+    opts = {"pool_pre_ping": os.getenv("DB_POOL_PRE_PING", "1").lower() in ("1", "true", "yes")}
+    if not (uri in ("sqlite://", "sqlite:///:memory:") or "mode=memory" in uri):
+        opts["poolclass"] = metrics.TimedQueuePool  # records pool checkout wait
+    if uri.startswith("sqlite"):
+        # SQLite pools are per-file and cheap; waiting on locks is handled by busy_timeout.
+        return opts
+    opts.update(
+        pool_size=int(os.getenv("DB_POOL_SIZE", "10")),
+        max_overflow=int(os.getenv("DB_MAX_OVERFLOW", "20")),
+        pool_recycle=int(os.getenv("DB_POOL_RECYCLE", "1800")),
+        pool_timeout=int(os.getenv("DB_POOL_TIMEOUT", "30")),
+    )
+    return opts
+
+@event.listens_for(Engine, "connect")
+def _sqlite_pragmas(dbapi_conn, record):
+    # WAL lets readers run alongside the single writer; NORMAL sync is safe
+    # under WAL (only the last transactions can be lost on power failure).
+    if not isinstance(dbapi_conn, sqlite3.Connection):
+        return
+    cur = dbapi_conn.cursor()
+    cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute(f"PRAGMA busy_timeout={int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))}")
+    cur.close()
+
+class _AppState:
+    """Per-app caches, pools and limiter, kept in app.extensions["amulet"].
+
+    They hold data read from the app's own database, so two apps built by
+    create_app() (e.g. on different databases) must never share them.
+    """
+
+    def __init__(self, app):
+        self.license_cache = LicenseCache(
+            size=int(os.getenv("LICENSE_CACHE_SIZE", "50000")),
+            ttl=float(os.getenv("LICENSE_CACHE_TTL", "60")),
+            negative_ttl=float(os.getenv("LICENSE_NEGATIVE_TTL", "30")),
+        )
+        self.public_cache = {}  # name -> (version, checked_at, body, etag)
+        self.public_cache_lock = threading.Lock()
+        self.key_pool = ApiKeyPool(lease_seconds=int(os.getenv("API_KEY_LEASE_SECONDS", "300")))
+        self.idem_cache = idempotency.ResultCache(size=int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "100000")),
+                                                  ttl=IDEMPOTENCY_TTL)
+        self.idem_pruned_at = time.monotonic()
+        self.changes_pruned_at = time.monotonic()
+        self.rate_limiter = _make_rate_limiter(app.config)
+
+def _state():
+    return current_app.extensions["amulet"]
+
+def create_app(config=None):
+    """Build the Flask app. The schema is not touched here; see init_db()."""
+    app = Flask(__name__, static_folder='.')
+    app.json = make_provider(app, os.getenv("JSON_PROVIDER", "auto"))
+    CORS(app)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('DATABASE_URL', 'sqlite:///amulet.db')
+    app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'secret')
+    # With DB_AUTO_INIT=0 the schema is only created by `flask init-db`
+    # (run once per deploy); otherwise the first request of each worker does it.
+    app.config['DB_AUTO_INIT'] = os.getenv("DB_AUTO_INIT", "1").lower() in ("1", "true", "yes")
+    app.config['ACTIVITY_LOG_ASYNC'] = os.getenv("ACTIVITY_LOG_ASYNC", "").lower() in ("1", "true", "yes")
+    app.config['RATE_LIMIT'] = os.getenv("RATE_LIMIT", "1").lower() in ("1", "true", "yes")
+    app.config['RATE_LIMIT_BACKEND'] = os.getenv("RATE_LIMIT_BACKEND", "memory")
+    app.config['RATE_LIMIT_REDIS_URL'] = os.getenv("RATE_LIMIT_REDIS_URL", "redis://localhost:6379/0")
+    app.config['RATE_LIMIT_MAX_BUCKETS'] = int(os.getenv("RATE_LIMIT_MAX_BUCKETS", "100000"))
+    app.config['RATE_LIMITS'] = os.getenv("RATE_LIMITS")  # None: the defaults below
+    # Only behind a trusted reverse proxy may X-Forwarded-For pick the client IP.
+    app.config['RATE_LIMIT_TRUST_PROXY'] = os.getenv("RATE_LIMIT_TRUST_PROXY", "").lower() in ("1", "true", "yes")
+    app.config.update(config or {})
+    app.config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', _engine_options(app.config['SQLALCHEMY_DATABASE_URI']))
+    db.init_app(app)
+    app.register_blueprint(bp)
+    app.extensions["amulet"] = _AppState(app)
+    if app.config['ACTIVITY_LOG_ASYNC']:
+        writer = ActivityLogWriter(
+            app,
+            spool_dir=_log_spool_dir(app),
+            flush_ms=int(os.getenv("ACTIVITY_LOG_FLUSH_MS", "200")),
+            batch=int(os.getenv("ACTIVITY_LOG_BATCH", "500")),
+            max_queue=int(os.getenv("ACTIVITY_LOG_MAX_QUEUE", "10000")),
+        )
+        app.extensions["activity_log_writer"] = writer
+        atexit.register(writer.stop)
+    return app
 
 # ---------- DB init + seed ----------
-with app.app_context():
+_init_lock = threading.Lock()
+
+def init_db():
+    """Create tables, run index migrations and seed defaults. Idempotent."""
     db.create_all()
+    run_migrations(db.engine)
     if Config.query.first() is None:
         cfg = Config(
             latest_version="1.0.0",
@@ -31,40 +138,370 @@ with app.app_context():
         )
         db.session.add(cfg)
         db.session.commit()
+    for name in ("voices", "config", "apikeys", "licenses"):
+        if db.session.get(CacheVersion, name) is None:
+            db.session.add(CacheVersion(name=name, version=0))
+    db.session.commit()
+
+def _ensure_db():
+    app = current_app._get_current_object()
+    if app.extensions.get("amulet_db_ready") or not app.config["DB_AUTO_INIT"]:
+        return
+    with _init_lock:
+        if not app.extensions.get("amulet_db_ready"):
+            init_db()
+            app.extensions["amulet_db_ready"] = True
+
+# Probes and /metrics never trigger init_db(): they must answer (readyz with
+# its own 503) even while the database is unreachable.
+_NO_INIT_ENDPOINTS = frozenset(("amulet.healthz", "amulet.readyz", "amulet.prometheus_metrics"))
+
+@bp.before_app_request
+def _lazy_init_db():
+    if request.endpoint not in _NO_INIT_ENDPOINTS:
+        _ensure_db()
+
+@bp.cli.command("init-db")
+def cli_init_db():
+    """Create/migrate the schema and seed defaults (run once per deploy)."""
+    init_db()
+    click.echo("Database initialized")
+
+# ---------- Request metrics ----------
+# Latency, SQL count/time and commit time per request go to metrics.REGISTRY
+# (served at /metrics). PROFILE_SLOWEST=N additionally samples request stacks
+# and keeps the N slowest for /admin_api/profile.
+PROFILE_SLOWEST = int(os.getenv("PROFILE_SLOWEST", "0"))
+_profiler = metrics.SlowRequestProfiler(
+    keep=PROFILE_SLOWEST, interval_ms=int(os.getenv("PROFILE_INTERVAL_MS", "5"))) if PROFILE_SLOWEST else None
+
+@bp.before_app_request
+def _metrics_begin():
+    g.metrics = [time.perf_counter(), 0, 0.0, None]  # t0, queries, sql seconds, commit start
+    if _profiler is not None: _profiler.begin()
+
+@bp.after_app_request
+def _metrics_end(response):
+    m = g.pop("metrics", None)
+    if m is None: return response
+    took = time.perf_counter() - m[0]
+    endpoint = (request.endpoint or "notfound").rpartition(".")[2]
+    action = g.get("api_action", "")
+    metrics.REQUEST_SECONDS.observe((endpoint, action, str(response.status_code)), took)
+    metrics.SQL_QUERIES.observe((endpoint, action), m[1])
+    metrics.SQL_SECONDS.observe((endpoint, action), m[2])
+    if response.status_code >= 500: metrics.ERRORS.inc((endpoint, "status_5xx"))
+    if _profiler is not None: _profiler.end(action or endpoint, took)
+    return response
+
+@bp.teardown_app_request
+def _metrics_exception(exc):
+    # GeneratorExit only means a streamed response was closed early by the client.
+    if exc is not None and not isinstance(exc, GeneratorExit):
+        metrics.ERRORS.inc(((request.endpoint or "notfound").rpartition(".")[2], exc.__class__.__name__))
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _sql_begin(conn, cursor, statement, parameters, context, executemany):
+    conn.info["sql_t0"] = time.perf_counter()
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _sql_end(conn, cursor, statement, parameters, context, executemany):
+    m = g.get("metrics") if has_request_context() else None
+    if m is not None:
+        m[1] += 1
+        m[2] += time.perf_counter() - conn.info.pop("sql_t0", time.perf_counter())
+
+@event.listens_for(Engine, "commit")
+def _commit_begin(conn):
+    m = g.get("metrics") if has_request_context() else None
+    if m is not None: m[3] = time.perf_counter()
+
+@event.listens_for(Session, "after_commit")
+def _commit_end(session):
+    m = g.get("metrics") if has_request_context() else None
+    if m is not None and m[3] is not None:
+        metrics.COMMIT_SECONDS.observe((), time.perf_counter() - m[3])
+        m[3] = None
+
+# ---------- Activity log pipeline ----------
+# With ACTIVITY_LOG_ASYNC=1 log rows leave the request path: they are handed
+# to a spooled background writer once the ledger transaction commits (and
+# dropped if it rolls back). Otherwise they are inserted in the transaction.
+
+def _log_spool_dir(app):
+    return os.getenv("ACTIVITY_LOG_SPOOL", os.path.join(app.instance_path, "activity_spool"))
+
+def _log_writer():
+    return current_app.extensions.get("activity_log_writer")
+
+def _log_activity(entries):
+    """Record (license_id, action, char_count, key) entries for the current transaction."""
+    if not entries: return
+    if _log_writer() is None:
+        now = datetime.utcnow()
+        rows = [{
+            "license_id": lid, "action": action, "char_count": n,
+            "details": format_details(action, n, key), "created_at": now
+        } for lid, action, n, key in entries]
+        db.session.execute(insert(ActivityLog), rows)
+        apply_rollups(rows)
+        return
+    now = datetime.utcnow().isoformat()
+    db.session.info.setdefault("pending_logs", []).extend(
+        [lid, action, n, key, now] for lid, action, n, key in entries)
+
+@event.listens_for(Session, "after_commit")
+def _submit_pending_logs(session):
+    pending = session.info.pop("pending_logs", None)
+    if pending: _log_writer().submit(pending)
+
+@event.listens_for(Session, "after_rollback")
+def _drop_pending_logs(session):
+    session.info.pop("pending_logs", None)
+
+# ---------- Change feed writers ----------
+# Admin-visible writes also append (entity, id, op, fields) events to the
+# change feed in the same transaction; see changefeed.py and /admin_api/changes.
+# CHANGE_FEED=0 turns it off, e.g. to keep debits to a single INSERT.
+CHANGE_FEED = os.getenv("CHANGE_FEED", "1").lower() not in ("0", "false", "no")
+CHANGE_FEED_RETENTION_HOURS = float(os.getenv("CHANGE_FEED_RETENTION_HOURS", "24"))
+CHANGE_FEED_PRUNE_INTERVAL = float(os.getenv("CHANGE_FEED_PRUNE_INTERVAL", "10"))
+
+def _record_changes(entries):
+    if CHANGE_FEED: changefeed.record(entries)
+
+def _fields(obj, names):
+    return {n: getattr(obj, n) for n in names}
 
 # ==================================================
 # ================ PUBLIC API (/api) ===============
 # ==================================================
-@app.route("/api", methods=["POST"])
+API_ACTIONS = frozenset(("check", "debit", "refund", "debit_batch", "refund_batch", "next_api_key",
+                         "release_api_key", "deactivate_api_key", "get_voices", "get_config"))
+
+@bp.route("/api", methods=["POST"])
 def public_api():
     data = request.get_json(force=True, silent=True) or {}
     action = (data.get("action") or "").strip()
+    # Unknown actions share one label/bucket so client-chosen strings stay out of both.
+    g.api_action = action if action in API_ACTIONS else "unknown"
+    throttled = _rate_limited(g.api_action, data)
+    if throttled is not None: return throttled
+    if action in IDEMPOTENT_ACTIONS:
+        replay = _idempotent_replay(action, data)
+        if replay is not None: return replay
     if action == "check":               return _api_check(data)
     if action == "debit":               return _api_debit(data)
     if action == "refund":              return _api_refund(data)
-    if action == "next_api_key":        return _api_next_api_key()
-    if action == "release_api_key":     return jsonify({"ok": True})
+    if action == "debit_batch":         return _api_ledger_batch(data, "debit")
+    if action == "refund_batch":        return _api_ledger_batch(data, "refund")
+    if action == "next_api_key":        return _api_next_api_key(data)
+    if action == "release_api_key":     return _api_release_api_key(data)
     if action == "deactivate_api_key":  return _api_deactivate_api_key(data)
     if action == "get_voices":          return _api_get_voices()
     if action == "get_config":          return _api_get_config()
     return jsonify({"ok": False, "msg": "Unknown action"})
 
+# ---------- Rate limiting ----------
+# Token buckets per action and per license key / MAC / client IP (see
+# ratelimit.py for the RATE_LIMITS format). The memory backend is per
+# worker; RATE_LIMIT_BACKEND=redis shares the buckets between workers.
+# The default per-IP budget only applies with RATE_LIMIT_TRUST_PROXY, since
+# behind a proxy remote_addr is the same for every client.
+def _make_rate_limiter(config):
+    if not config["RATE_LIMIT"]:
+        return None
+    if config["RATE_LIMIT_BACKEND"] == "redis":
+        backend = RedisBackend(config["RATE_LIMIT_REDIS_URL"])
+    else:
+        backend = MemoryBackend(max_entries=config["RATE_LIMIT_MAX_BUCKETS"])
+    spec = config["RATE_LIMITS"]
+    if spec is None:
+        spec = DEFAULT_LIMITS + (";" + DEFAULT_IP_LIMITS if config["RATE_LIMIT_TRUST_PROXY"] else "")
+    return RateLimiter(parse_limits(spec), backend)
+
+def _rate_limited(action, data):
+    limiter = _state().rate_limiter
+    if limiter is None: return None
+    trust_proxy = current_app.config["RATE_LIMIT_TRUST_PROXY"]
+    ip = request.access_route[0] if trust_proxy and request.access_route else request.remote_addr
+    wait, limited = limiter.check(action, {
+        "key": str(data.get("key") or "").strip(),
+        "mac": str(data.get("mac") or "").strip(),
+        "ip": ip,
+    })
+    if not limited: return None
+    for dim in limited: metrics.RATE_LIMITED.inc((action, dim))
+    resp = jsonify({"ok": False, "msg": "Rate limit exceeded", "retry_after": round(wait, 3)})
+    resp.status_code = 429
+    resp.headers["Retry-After"] = RateLimiter.retry_after_header(wait)
+    return resp
+
+# ---------- License status cache ----------
+# `check` reads (id, active, mac_id, credit) from a per-worker LRU, including
+# negative entries for unknown keys. License writers bump the "licenses"
+# CacheVersion; workers compare it at most once per PUBLIC_CACHE_TTL and
+# flush on change.
+def _license_status(key):
+    cache = _state().license_cache
+    if time.monotonic() - cache.checked_at >= PUBLIC_CACHE_TTL or cache.version is None:
+        cache.sync(db.session.execute(
+            select(CacheVersion.version).where(CacheVersion.name == "licenses")).scalar() or 0)
+    found, status = cache.get(key)
+    if found: return status
+    row = db.session.execute(
+        select(License.id, License.active, License.mac_id, License.credit).where(License.key == key)).first()
+    status = tuple(row) if row else None
+    cache.put(key, status)
+    return status
+
+# ---------- Idempotent ledger requests ----------
+# debit/refund (and their batch forms) accept an optional `request_id`. The
+# first successful result is stored with the ledger write and replayed to
+# retries with "replayed": true; see idempotency.py.
+IDEMPOTENT_ACTIONS = frozenset(("debit", "refund", "debit_batch", "refund_batch"))
+IDEMPOTENCY_TTL = float(os.getenv("IDEMPOTENCY_TTL", "86400"))
+IDEMPOTENCY_PRUNE_INTERVAL = float(os.getenv("IDEMPOTENCY_PRUNE_INTERVAL", "600"))
+REQUEST_ID_MAX = 128
+
+def _replay_body(fp, hit):
+    if hit[0] != fp:
+        return {"ok": False, "msg": "request_id was already used for a different request"}
+    return {**hit[1], "replayed": True}
+
+def _idempotent_replay(action, data):
+    """Stored response for a retried request_id, or None to run the request."""
+    g.idempotency = None
+    rid = str(data.get("request_id") or "").strip()
+    key = str(data.get("key") or "").strip()
+    if not rid or not key: return None
+    if len(rid) > REQUEST_ID_MAX:
+        return jsonify({"ok": False, "msg": f"request_id too long (max {REQUEST_ID_MAX})"})
+    fp = idempotency.fingerprint(data)
+    cache = _state().idem_cache
+    hit = cache.get(key, rid)
+    if hit is None:
+        stored = idempotency.lookup(key, rid)
+        if stored is None:
+            g.idempotency = (key, rid, fp)
+            return None
+        hit = stored[:2]
+        cache.put(key, rid, hit[0], hit[1], age=stored[2])
+        metrics.IDEMPOTENT_REPLAYS.inc(("db",))
+    else:
+        metrics.IDEMPOTENT_REPLAYS.inc(("memory",))
+    return jsonify(_replay_body(fp, hit))
+
+def _ledger_commit(body):
+    """Commit a successful ledger write, storing `body` under the request_id.
+
+    Returns (response body, committed). When a concurrent retry with the same
+    request_id committed first, this write is rolled back and its result
+    is returned instead.
+    """
+    idem = g.get("idempotency")
+    if idem is not None:
+        key, rid, fp = idem
+        try:
+            idempotency.save(key, rid, fp, body)
+        except IntegrityError:
+            db.session.rollback()
+            stored = idempotency.lookup(key, rid)
+            if stored is None: raise
+            return _replay_body(fp, stored[:2]), False
+    db.session.commit()
+    st = _state()
+    if idem is not None:
+        st.idem_cache.put(key, rid, fp, body)
+    _prune_expired(st)
+    return body, True
+
+def _prune_expired(st):
+    """Opportunistic TTL eviction: one small batch per table per worker per interval."""
+    now = time.monotonic()
+    if now - st.idem_pruned_at >= IDEMPOTENCY_PRUNE_INTERVAL:
+        st.idem_pruned_at = now
+        idempotency.prune(IDEMPOTENCY_TTL, max_batches=1)
+    if CHANGE_FEED and now - st.changes_pruned_at >= CHANGE_FEED_PRUNE_INTERVAL:
+        # Every ledger write appends an event, so this keeps pace with debits.
+        st.changes_pruned_at = now
+        changefeed.prune(CHANGE_FEED_RETENTION_HOURS, max_batches=1)
+
+@bp.cli.command("prune-idempotency")
+def cli_prune_idempotency():
+    """Delete stored request_id results older than IDEMPOTENCY_TTL."""
+    _ensure_db()
+    n = idempotency.prune(IDEMPOTENCY_TTL)
+    click.echo(f"Deleted {n} idempotency records")
+
 def _api_check(req):
     key = (req.get("key") or "").strip()
     mac = (req.get("mac") or "").strip()
     if not key or not mac:
         return jsonify({"ok": False, "msg": "key/mac required"})
-    lic = License.query.filter_by(key=key).first()
+    lic = _license_status(key)
     if not lic: return jsonify({"ok": False, "msg": "License not found"})
-    if not lic.active: return jsonify({"ok": False, "msg": "License inactive"})
+    lic_id, active, mac_id, credit = lic
+    if not active: return jsonify({"ok": False, "msg": "License inactive"})
 
-    if not lic.mac_id:
-        lic.mac_id = mac
-        lic.updated_at = datetime.utcnow()
+    if not mac_id:
+        # Bind on first check. The entry may be stale, so the UPDATE only
+        # matches a still-unbound row; the loser re-reads the winner's mac.
+        res = db.session.execute(
+            update(License).where(License.id == lic_id, or_(License.mac_id.is_(None), License.mac_id == ""))
+            .values(mac_id=mac, updated_at=datetime.utcnow()).execution_options(synchronize_session=False))
+        if res.rowcount == 1: _record_changes([("license", lic_id, "update", {"mac_id": mac})])
         db.session.commit()
-    elif lic.mac_id != mac:
+        _state().license_cache.invalidate(key)
+        if res.rowcount == 1:
+            return jsonify({"ok": True, "credit": credit})
+        lic = _license_status(key)
+        if not lic: return jsonify({"ok": False, "msg": "License not found"})
+        mac_id, credit = lic[2], lic[3]
+    if mac_id != mac:
         return jsonify({"ok": False, "msg": "License activated on another device"})
-    return jsonify({"ok": True, "credit": lic.credit})
+    return jsonify({"ok": True, "credit": credit})
+
+def _ledger_apply(key, mac, delta, require_active=True, min_credit=None):
+    """Apply `delta` to a license balance in a single conditional UPDATE.
+
+    The guard (key, bound mac, active, sufficient credit) is evaluated by the
+    database together with the write, so concurrent debits can never read the
+    same balance and both succeed. `min_credit` overrides the balance floor
+    (defaults to the debited amount). Returns (license_id, credit) or None
+    when the guard did not match.
+    """
+    conds = [License.key == key, License.mac_id == mac]
+    if require_active:
+        conds.append(License.active == True)  # noqa: E712
+    if min_credit is None and delta < 0:
+        min_credit = -delta
+    if min_credit:
+        conds.append(License.credit >= min_credit)
+    stmt = (update(License).where(*conds)
+            .values(credit=License.credit + delta, updated_at=datetime.utcnow())
+            .execution_options(synchronize_session=False))
+    if db.engine.dialect.update_returning:
+        row = db.session.execute(stmt.returning(License.id, License.credit)).first()
+        return (row[0], row[1]) if row else None
+    # Fallback for SQLite < 3.35 (no RETURNING): the UPDATE already holds the
+    # write lock, so reading the balance back in the same transaction is safe.
+    if db.session.execute(stmt).rowcount != 1:
+        return None
+    row = db.session.execute(select(License.id, License.credit).where(License.key == key)).first()
+    return (row[0], row[1])
+
+def _ledger_diagnose(key, mac, require_active=True):
+    # Only reached when the conditional UPDATE matched nothing: work out why.
+    lic = License.query.filter_by(key=key).first()
+    if not lic: return {"ok": False, "msg": "License not found"}
+    if require_active and not lic.active: return {"ok": False, "msg": "License inactive"}
+    if lic.mac_id != mac: return {"ok": False, "msg": "MAC mismatch or not bound"}
+    return {"ok": False, "msg": "Insufficient credit", "credit": lic.credit}
+
+def _ledger_reject(key, mac, require_active=True):
+    db.session.rollback()
+    return jsonify(_ledger_diagnose(key, mac, require_active))
 
 def _api_debit(req):
     key = (req.get("key") or "").strip()
@@ -73,24 +510,14 @@ def _api_debit(req):
     if not key or not mac: return jsonify({"ok": False, "msg": "key/mac required"})
     if cnt <= 0:           return jsonify({"ok": False, "msg": "count must be > 0"})
 
-    lic = License.query.filter_by(key=key).first()
-    if not lic: return jsonify({"ok": False, "msg": "License not found"})
-    if not lic.active: return jsonify({"ok": False, "msg": "License inactive"})
-    if lic.mac_id != mac: return jsonify({"ok": False, "msg": "MAC mismatch or not bound"})
-    if lic.credit < cnt: return jsonify({"ok": False, "msg": "Insufficient credit", "credit": lic.credit})
-
-    lic.credit -= cnt
-    lic.updated_at = datetime.utcnow()
-    # Log the debit action
-    log = ActivityLog(
-        license_id=lic.id,
-        action="debit",
-        char_count=cnt,
-        details=f"Debited {cnt} credits for key {key}"
-    )
-    db.session.add(log)
-    db.session.commit()
-    return jsonify({"ok": True, "debited": cnt, "credit": lic.credit})
+    res = _ledger_apply(key, mac, -cnt)
+    if res is None: return _ledger_reject(key, mac)
+    lic_id, credit = res
+    _log_activity([(lic_id, "debit", cnt, key)])
+    _record_changes([("license", lic_id, "debit", {"credit": credit, "count": cnt})])
+    body, committed = _ledger_commit({"ok": True, "debited": cnt, "credit": credit})
+    if committed: _state().license_cache.update_credit(key, credit)
+    return jsonify(body)
 
 def _api_refund(req):
     key = (req.get("key") or "").strip()
@@ -99,27 +526,134 @@ def _api_refund(req):
     if not key or not mac: return jsonify({"ok": False, "msg": "key/mac required"})
     if cnt <= 0:           return jsonify({"ok": False, "msg": "count must be > 0"})
 
-    lic = License.query.filter_by(key=key).first()
-    if not lic: return jsonify({"ok": False, "msg": "License not found"})
-    if lic.mac_id != mac: return jsonify({"ok": False, "msg": "MAC mismatch or not bound"})
+    res = _ledger_apply(key, mac, cnt, require_active=False)
+    if res is None: return _ledger_reject(key, mac, require_active=False)
+    lic_id, credit = res
+    _log_activity([(lic_id, "refund", cnt, key)])
+    _record_changes([("license", lic_id, "refund", {"credit": credit, "count": cnt})])
+    body, committed = _ledger_commit({"ok": True, "refunded": cnt, "credit": credit})
+    if committed: _state().license_cache.update_credit(key, credit)
+    return jsonify(body)
 
-    lic.credit += cnt
-    lic.updated_at = datetime.utcnow()
-    # Log the refund action
-    log = ActivityLog(
-        license_id=lic.id,
-        action="refund",
-        char_count=cnt,
-        details=f"Refunded {cnt} credits for key {key}"
-    )
-    db.session.add(log)
-    db.session.commit()
-    return jsonify({"ok": True, "refunded": cnt, "credit": lic.credit})
+LEDGER_BATCH_MAX = int(os.getenv("LEDGER_BATCH_MAX", "1000"))
+
+def _parse_ledger_ops(req, default_op):
+    """Normalize `counts` ([n, ...]) and/or `ops` ([{"op", "count"}, ...])."""
+    counts, items = req.get("counts") or [], req.get("ops") or []
+    if not isinstance(counts, list): return None, "counts must be a list"
+    if not isinstance(items, list): return None, "ops must be a list"
+    ops = [{"op": default_op, "count": c} for c in counts] + items
+    out = []
+    for item in ops:
+        if not isinstance(item, dict):
+            return None, "ops items must be objects"
+        op = (item.get("op") or default_op).strip()
+        if op not in ("debit", "refund"):
+            return None, f"unknown op: {op}"
+        try:
+            cnt = int(item.get("count") or 0)
+        except (TypeError, ValueError):
+            return None, "count must be an integer"
+        if cnt <= 0:
+            return None, "count must be > 0"
+        out.append((op, cnt))
+    return out, None
+
+def _api_ledger_batch(req, default_op):
+    """Settle many debit/refund ops for one key+mac in a single transaction.
+
+    mode="atomic" (default) applies the whole batch with one conditional
+    UPDATE or nothing at all; mode="partial" applies ops in order and skips
+    debits that would overdraw the balance.
+    """
+    key = (req.get("key") or "").strip()
+    mac = (req.get("mac") or "").strip()
+    mode = (req.get("mode") or "atomic").strip()
+    if not key or not mac: return jsonify({"ok": False, "msg": "key/mac required"})
+    if mode not in ("atomic", "partial"): return jsonify({"ok": False, "msg": "mode must be atomic or partial"})
+    ops, err = _parse_ledger_ops(req, default_op)
+    if err: return jsonify({"ok": False, "msg": err})
+    if not ops: return jsonify({"ok": False, "msg": "counts/ops required"})
+    if len(ops) > LEDGER_BATCH_MAX:
+        return jsonify({"ok": False, "msg": f"batch too large (max {LEDGER_BATCH_MAX})"})
 
-def _api_next_api_key():
-    k = ApiKey.query.filter_by(status="active").first()
-    if not k: return jsonify({"ok": False, "msg": "No active API keys"})
-    return jsonify({"ok": True, "api_key": k.api_key, "status": "active"})
+    signed = [-cnt if op == "debit" else cnt for op, cnt in ops]
+    has_debit = any(d < 0 for d in signed)
+    results = []
+    if mode == "atomic":
+        # The balance must never dip below zero part-way through the batch,
+        # so guard on the lowest running total rather than the net delta.
+        running, lowest = 0, 0
+        for d in signed:
+            running += d
+            lowest = min(lowest, running)
+        res = _ledger_apply(key, mac, running, require_active=has_debit, min_credit=-lowest)
+        if res is None: return _ledger_reject(key, mac, require_active=has_debit)
+        lic_id, credit = res
+        balance = credit - running
+        for (op, cnt), d in zip(ops, signed):
+            balance += d
+            results.append({"op": op, "count": cnt, "ok": True, "credit": balance})
+    else:
+        lic_id, credit, diag = None, None, None
+        for (op, cnt), d in zip(ops, signed):
+            res = _ledger_apply(key, mac, d, require_active=(op == "debit"))
+            if res is not None:
+                lic_id, credit = res
+                results.append({"op": op, "count": cnt, "ok": True, "credit": credit})
+                continue
+            diag = diag or _ledger_diagnose(key, mac, require_active=(op == "debit"))
+            if diag["msg"] != "Insufficient credit":
+                db.session.rollback()
+                return jsonify(diag)
+            if credit is None: credit = diag["credit"]
+            results.append({"op": op, "count": cnt, "ok": False, "msg": diag["msg"], "credit": credit})
+
+    _log_activity([(lic_id, r["op"], r["count"], key) for r in results if r["ok"]])
+    debited = sum(r["count"] for r in results if r["ok"] and r["op"] == "debit")
+    refunded = sum(r["count"] for r in results if r["ok"] and r["op"] == "refund")
+    body = {"ok": True, "results": results, "debited": debited, "refunded": refunded, "credit": credit}
+    if not (debited or refunded):
+        # Nothing was charged, so there is no result to replay: a retry after
+        # a top-up must run again rather than see these failures.
+        db.session.rollback()
+        return jsonify(body)
+    _record_changes([("license", lic_id, "batch",
+                      {"credit": credit, "debited": debited, "refunded": refunded})])
+    body, committed = _ledger_commit(body)
+    if committed and lic_id is not None: _state().license_cache.update_credit(key, credit)
+    return jsonify(body)
+
+# ---------- API key pool ----------
+# Leases are per worker; the pool rebuilds from the ApiKey table whenever the
+# "apikeys" CacheVersion changes (checked at most once per PUBLIC_CACHE_TTL).
+def _sync_key_pool():
+    pool = _state().key_pool
+    if time.monotonic() - pool.checked_at < PUBLIC_CACHE_TTL and pool.version is not None:
+        return pool
+    ver = db.session.execute(
+        select(CacheVersion.version).where(CacheVersion.name == "apikeys")).scalar() or 0
+    if ver == pool.version:
+        pool.checked_at = time.monotonic()
+        return pool
+    rows = db.session.execute(select(ApiKey.id, ApiKey.api_key).where(ApiKey.status == "active")).all()
+    pool.sync(rows, version=ver)
+    return pool
+
+def _api_next_api_key(req):
+    pool = _sync_key_pool()
+    holder = (req.get("key") or req.get("mac") or "").strip()
+    res = pool.lease(holder)
+    if not res: return jsonify({"ok": False, "msg": "No active API keys"})
+    api_key, until = res
+    return jsonify({"ok": True, "api_key": api_key, "status": "active",
+                    "lease_until": datetime.utcfromtimestamp(until).isoformat()})
+
+def _api_release_api_key(req):
+    api_key = (req.get("api_key") or "").strip()
+    if not api_key: return jsonify({"ok": False, "msg": "api_key required"})
+    holder = (req.get("key") or req.get("mac") or "").strip()
+    return jsonify({"ok": True, "released": _state().key_pool.release(api_key, holder)})
 
 def _api_deactivate_api_key(req):
     api_key = (req.get("api_key") or "").strip()
@@ -127,17 +661,58 @@ def _api_deactivate_api_key(req):
     k = ApiKey.query.filter_by(api_key=api_key).first()
     if not k: return jsonify({"ok": False, "msg": "API key not found"})
     k.status = "inactive"
+    _record_changes([("apikey", k.id, "update", {"status": "inactive"})])
+    _bump_cache_version("apikeys")
     db.session.commit()
+    _state().key_pool.discard(api_key)
     return jsonify({"ok": True, "status": "inactive"})
 
-def _api_get_voices():
+# ---------- Public read cache ----------
+# get_voices / get_config responses are kept as serialized bytes per worker.
+# Admin writers bump a DB-stored version counter (CacheVersion) in the same
+# transaction, and each worker re-checks that counter at most once per TTL.
+PUBLIC_CACHE_TTL = float(os.getenv("PUBLIC_CACHE_TTL", "5"))
+
+def _bump_cache_version(*names):
+    st = _state()
+    for name in names:
+        res = db.session.execute(
+            update(CacheVersion).where(CacheVersion.name == name)
+            .values(version=CacheVersion.version + 1)
+            .execution_options(synchronize_session=False))
+        if not res.rowcount:
+            db.session.add(CacheVersion(name=name, version=1))
+        st.public_cache.pop(name, None)
+        if name == "apikeys": st.key_pool.checked_at = 0.0
+        if name == "licenses": st.license_cache.checked_at = 0.0
+
+def _cached_public(name, build):
+    st = _state()
+    now = time.monotonic()
+    ent = st.public_cache.get(name)
+    if ent is None or now - ent[1] >= PUBLIC_CACHE_TTL:
+        ver = db.session.execute(
+            select(CacheVersion.version).where(CacheVersion.name == name)).scalar() or 0
+        if ent is not None and ent[0] == ver:
+            ent = (ver, now, ent[2], ent[3])
+        else:
+            body = current_app.json.dumpb(build())
+            ent = (ver, now, body, hashlib.sha1(body).hexdigest()[:20])
+        with st.public_cache_lock:
+            st.public_cache[name] = ent
+    headers = {"ETag": f'"{ent[3]}"', "Cache-Control": f"private, max-age={int(PUBLIC_CACHE_TTL)}"}
+    if ent[3] in request.if_none_match:
+        return Response(status=304, headers=headers)
+    return Response(ent[2], mimetype="application/json", headers=headers)
+
+def _voices_payload():
     vs = Voice.query.filter_by(active=True).all()
     out = [{"name": v.name, "voice_id": v.voice_id} for v in vs]
-    return jsonify({"ok": True, "voices": out})
+    return {"ok": True, "voices": out}
 
-def _api_get_config():
+def _config_payload():
     c = Config.query.first()
-    if not c: return jsonify({"ok": False, "msg": "Config missing"})
+    if not c: return {"ok": False, "msg": "Config missing"}
     links = []
     raw = (c.update_links or "").strip()
     if raw:
@@ -148,38 +723,157 @@ def _api_get_config():
                 links = []
         else:
             links = [s.strip() for s in raw.split(",") if s.strip()]
-    return jsonify({"ok": True, "config": {
+    return {"ok": True, "config": {
         "latest_version": c.latest_version,
         "force_update": c.force_update,
         "maintenance": c.maintenance,
         "maintenance_message": c.maintenance_message,
         "update_description": c.update_description,
         "update_links": links
-    }})
+    }}
+
+def _api_get_voices():
+    return _cached_public("voices", _voices_payload)
+
+def _api_get_config():
+    return _cached_public("config", _config_payload)
 
 # ==================================================
 # ============== ADMIN REST (/admin_api) ===========
 # ==================================================
 
+# ---------- Keyset pagination ----------
+# List endpoints return one page ordered by id desc. `before=<id>` continues
+# from a cursor, `limit` caps the page and `fields=a,b` projects columns.
+# X-Next-Cursor is set when more rows exist; X-Total-Count on the first page.
+ADMIN_PAGE_DEFAULT = 200
+ADMIN_PAGE_MAX = 1000
+
+def _json_rows(names, rows):
+    """Row tuples straight to a JSON array response, no ORM objects or per-cell Python."""
+    return current_app.response_class(current_app.json.dump_rows(names, rows), mimetype="application/json")
+
+def _fmt_cell(v):
+    if isinstance(v, datetime): return v.isoformat()
+    return "" if v is None else v
+
+def _count_rows(model, filters):
+    if not filters and db.engine.dialect.name == "postgresql":
+        # Planner estimate instead of a full count(*) scan on big tables.
+        est = db.session.execute(text("SELECT reltuples::bigint FROM pg_class WHERE relname = :t"),
+                                 {"t": model.__tablename__}).scalar()
+        if est and est > 0: return est
+    return db.session.execute(select(func.count()).select_from(model).where(*filters)).scalar()
+
+def _admin_page(model, fields, filters=()):
+    limit = request.args.get("limit", ADMIN_PAGE_DEFAULT, type=int)
+    limit = min(max(limit, 1), ADMIN_PAGE_MAX)
+    before = request.args.get("before", type=int)
+    wanted = {f.strip() for f in (request.args.get("fields") or "").split(",") if f.strip()}
+    names = ["id"] + [f for f in fields if f != "id" and (not wanted or f in wanted)]
+    stmt = select(*[getattr(model, n) for n in names]).where(*filters)
+    if before is not None:
+        stmt = stmt.where(model.id < before)
+    rows = db.session.execute(stmt.order_by(model.id.desc()).limit(limit + 1)).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    resp = _json_rows(names, rows)
+    if more: resp.headers["X-Next-Cursor"] = str(rows[-1][0])
+    if before is None: resp.headers["X-Total-Count"] = str(_count_rows(model, list(filters)))
+    return resp
+
+# ---------- Change feed ----------
+# GET /admin_api/changes                  -> {"last": head seq} to start from
+# GET /admin_api/changes?since=N&wait=25  -> long-poll for events after N
+# Accept: text/event-stream               -> SSE stream (honours Last-Event-ID)
+# "reset": true means `since` is no longer covered: refetch, continue from last.
+CHANGE_FEED_POLL = float(os.getenv("CHANGE_FEED_POLL", "1"))
+CHANGE_FEED_WAIT_MAX = 30.0
+# Streams end after this long so a gthread worker thread is never held
+# forever; EventSource reconnects on its own with Last-Event-ID.
+CHANGE_FEED_STREAM_SECONDS = float(os.getenv("CHANGE_FEED_STREAM_SECONDS", "300"))
+CHANGE_FEED_HEARTBEAT = 15.0
+
+def _change_stream(since):
+    dumps = current_app.json.dumps
+    deadline = time.monotonic() + CHANGE_FEED_STREAM_SECONDS
+    quiet_since = time.monotonic()
+    yield "retry: 2000\n\n"
+    while time.monotonic() < deadline:
+        reset, last, events = changefeed.fetch(since)
+        db.session.rollback()  # end the read transaction so the next poll sees new commits
+        if reset:
+            yield f"id: {last}\nevent: reset\ndata: {last}\n\n"
+        for ev in events:
+            yield f"id: {ev['seq']}\nevent: change\ndata: {dumps(ev)}\n\n"
+        since = last
+        if reset or events:
+            quiet_since = time.monotonic()
+            continue
+        if time.monotonic() - quiet_since >= CHANGE_FEED_HEARTBEAT:
+            yield ": ping\n\n"
+            quiet_since = time.monotonic()
+        changefeed.wait(CHANGE_FEED_POLL)
+
+@bp.route("/admin_api/changes", methods=["GET"])
+def adm_changes():
+    if not CHANGE_FEED: return jsonify({"ok": False, "msg": "change feed disabled"}), 404
+    # An EventSource reconnect resends the original URL, so Last-Event-ID wins.
+    since = request.headers.get("Last-Event-ID", type=int)
+    if since is None: since = request.args.get("since", type=int)
+    if request.accept_mimetypes.best == "text/event-stream":
+        if since is None: since = changefeed.head()
+        return Response(stream_with_context(_change_stream(since)), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+    if since is None:
+        return jsonify({"ok": True, "reset": False, "last": changefeed.head(), "events": []})
+    wait = min(max(request.args.get("wait", 0, type=float), 0.0), CHANGE_FEED_WAIT_MAX)
+    deadline = time.monotonic() + wait
+    while True:
+        reset, last, events = changefeed.fetch(since)
+        left = deadline - time.monotonic()
+        if reset or events or left <= 0: break
+        db.session.rollback()
+        changefeed.wait(min(CHANGE_FEED_POLL, left))
+    return jsonify({"ok": True, "reset": reset, "last": last, "events": events})
+
+@bp.cli.command("prune-changes")
+@click.option("--older-than-hours", type=float, default=lambda: CHANGE_FEED_RETENTION_HOURS,
+              show_default="CHANGE_FEED_RETENTION_HOURS or 24")
+def cli_prune_changes(older_than_hours):
+    """Delete change feed events older than the cutoff."""
+    _ensure_db()
+    n = changefeed.prune(older_than_hours)
+    click.echo(f"Deleted {n} change feed events")
+
 # ---------- Licenses ----------
-@app.route("/admin_api/licenses", methods=["GET"])
+def _license_search(q):
+    """Index-friendly key/MAC filter for the admin search boxes.
+
+    PostgreSQL keeps substring matching through the pg_trgm indexes (3+
+    chars). Elsewhere `q` matches case-insensitively as a key/MAC prefix,
+    using range scans on the lower(key) / lower(mac_id) expression indexes
+    (see migrations.py). The ranges are a UNION subquery so SQLite cannot
+    fall back to walking the id order and filtering.
+    """
+    if db.engine.dialect.name == "postgresql" and len(q) >= 3:
+        like = f"%{q}%"
+        return db.or_(License.key.ilike(like), License.mac_id.ilike(like))
+    lo = q.lower()
+    hi = lo + "\uffff"
+    parts = [select(License.id).where(func.lower(col) >= lo, func.lower(col) < hi)
+             for col in (License.key, License.mac_id)]
+    return License.id.in_(union(*parts))
+
+LICENSE_FIELDS = ("id", "key", "mac_id", "credit", "active", "created_at", "updated_at")
+
+@bp.route("/admin_api/licenses", methods=["GET"])
 def adm_list_licenses():
     q = (request.args.get("q") or "").strip()
-    query = License.query
-    if q:
-        like = f"%{q}%"
-        query = query.filter(
-            db.or_(License.key.ilike(like), License.mac_id.ilike(like))
-        )
-    items = query.order_by(License.id.desc()).all()
-    return jsonify([{
-        "id": x.id, "key": x.key, "mac_id": x.mac_id or "",
-        "credit": x.credit, "active": x.active,
-        "created_at": x.created_at.isoformat() if x.created_at else "",
-        "updated_at": x.updated_at.isoformat() if x.updated_at else ""
-    } for x in items])
-
-@app.route("/admin_api/licenses", methods=["POST"])
+    filters = [_license_search(q)] if q else []
+    return _admin_page(License, LICENSE_FIELDS, filters)
+
+@bp.route("/admin_api/licenses", methods=["POST"])
 def adm_create_license():
     data = request.get_json(force=True, silent=True) or {}
     key = (data.get("key") or "").strip()
@@ -193,14 +887,19 @@ def adm_create_license():
         active=bool(data.get("active")) if data.get("active") is not None else True
     )
     db.session.add(lic)
+    db.session.flush()
+    _record_changes([("license", lic.id, "create", _fields(lic, LICENSE_FIELDS))])
+    _bump_cache_version("licenses")
     db.session.commit()
+    _state().license_cache.invalidate(key)
     return jsonify({"ok": True, "id": lic.id})
 
-@app.route("/admin_api/licenses/<int:lid>", methods=["PUT"])
+@bp.route("/admin_api/licenses/<int:lid>", methods=["PUT"])
 def adm_update_license(lid):
     lic = License.query.get(lid)
     if not lic: return jsonify({"ok": False, "msg": "not found"}), 404
     data = request.get_json(force=True, silent=True) or {}
+    old_key = lic.key
     if "key" in data:
         new_key = (data.get("key") or "").strip()
         if not new_key: return jsonify({"ok": False, "msg": "key cannot be empty"}), 400
@@ -211,52 +910,189 @@ def adm_update_license(lid):
     if "credit" in data: lic.credit = max(0, int(data.get("credit") or 0))
     if "active" in data: lic.active = bool(data.get("active"))
     lic.updated_at = datetime.utcnow()
+    changed = [n for n in ("key", "mac_id", "credit", "active") if n in data] + ["updated_at"]
+    _record_changes([("license", lid, "update", _fields(lic, changed))])
+    _bump_cache_version("licenses")
     db.session.commit()
+    _state().license_cache.invalidate(old_key, lic.key)
     return jsonify({"ok": True})
 
-@app.route("/admin_api/licenses/<int:lid>", methods=["DELETE"])
+@bp.route("/admin_api/licenses/<int:lid>", methods=["DELETE"])
 def adm_delete_license(lid):
     lic = License.query.get(lid)
     if not lic: return jsonify({"ok": False, "msg": "not found"}), 404
+    key = lic.key
     db.session.delete(lic)
+    _record_changes([("license", lid, "delete", None)])
+    _bump_cache_version("licenses")
     db.session.commit()
+    _state().license_cache.invalidate(key)
     return jsonify({"ok": True})
 
-@app.route("/admin_api/licenses/<int:lid>/toggle", methods=["POST"])
+@bp.route("/admin_api/licenses/<int:lid>/toggle", methods=["POST"])
 def adm_toggle_license(lid):
     lic = License.query.get(lid)
     if not lic: return jsonify({"ok": False, "msg": "not found"}), 404
     lic.active = not lic.active
     lic.updated_at = datetime.utcnow()
+    _record_changes([("license", lid, "update", _fields(lic, ("active", "updated_at")))])
+    _bump_cache_version("licenses")
     db.session.commit()
+    _state().license_cache.invalidate(lic.key)
     return jsonify({"ok": True, "active": lic.active})
 
-@app.route("/admin_api/licenses/<int:lid>/credit", methods=["POST"])
+def _clamped_credit(delta):
+    """SET expression adding `delta` to the stored balance, floored at 0."""
+    credit = func.coalesce(License.credit, 0) + delta
+    return case((credit < 0, 0), else_=credit)
+
+@bp.route("/admin_api/licenses/<int:lid>/credit", methods=["POST"])
 def adm_adjust_credit(lid):
-    lic = License.query.get(lid)
-    if not lic: return jsonify({"ok": False, "msg": "not found"}), 404
     data = request.get_json(force=True, silent=True) or {}
     delta = int(data.get("delta") or 0)
-    lic.credit = max(0, (lic.credit or 0) + delta)
-    lic.updated_at = datetime.utcnow()
-    # Log the credit adjustment
-    log = ActivityLog(
-        license_id=lic.id,
-        action="adjust_credit",
-        char_count=delta,
-        details=f"Adjusted credit by {delta} for key {lic.key}"
-    )
-    db.session.add(log)
+    # One UPDATE on the stored balance, like the ledger, so a concurrent
+    # debit is never overwritten by a stale read-modify-write.
+    now = datetime.utcnow()
+    stmt = (update(License).where(License.id == lid)
+            .values(credit=_clamped_credit(delta), updated_at=now)
+            .execution_options(synchronize_session=False))
+    if db.engine.dialect.update_returning:
+        row = db.session.execute(stmt.returning(License.key, License.credit)).first()
+    elif db.session.execute(stmt).rowcount == 1:
+        row = db.session.execute(select(License.key, License.credit).where(License.id == lid)).first()
+    else:
+        row = None
+    if row is None: return jsonify({"ok": False, "msg": "not found"}), 404
+    key, credit = row
+    _log_activity([(lid, "adjust_credit", delta, key)])
+    _record_changes([("license", lid, "update", {"credit": credit, "updated_at": now})])
+    db.session.commit()
+    _state().license_cache.update_credit(key, credit)
+    return jsonify({"ok": True, "credit": credit})
+
+# ---------- Bulk license operations ----------
+# Set-based: one INSERT / UPDATE per chunk of BULK_CHUNK rows (kept under
+# SQLite's bound-parameter limit), never one ORM object per license.
+BULK_CHUNK = 5000
+BULK_GENERATE_MAX = int(os.getenv("BULK_GENERATE_MAX", "100000"))
+
+def _random_key(prefix, length):
+    return prefix + base64.b32encode(os.urandom(length * 5 // 8 + 1)).decode()[:length]
+
+def _insert_new_licenses(rows):
+    """INSERT rows, skipping keys that already exist; returns the inserted (id, key) pairs."""
+    stmt = dialect_insert(License)
+    if stmt is not None and db.engine.dialect.insert_returning:
+        stmt = stmt.on_conflict_do_nothing(index_elements=["key"]).returning(License.id, License.key)
+        return db.session.execute(stmt, rows).all()
+    keys = [r["key"] for r in rows]
+    taken = set(db.session.execute(select(License.key).where(License.key.in_(keys))).scalars())
+    rows = [r for r in rows if r["key"] not in taken]
+    if not rows: return []
+    db.session.execute(insert(License), rows)
+    return db.session.execute(
+        select(License.id, License.key).where(License.key.in_([r["key"] for r in rows]))).all()
+
+@bp.route("/admin_api/licenses/bulk/generate", methods=["POST"])
+def adm_bulk_generate_licenses():
+    """Create `count` licenses with random keys; returns the new keys."""
+    data = request.get_json(force=True, silent=True) or {}
+    try:
+        count = int(data.get("count") or 0)
+        length = int(data.get("length") or 16)
+        credit = max(0, int(data.get("credit") or 0))
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "msg": "count, length and credit must be integers"}), 400
+    if not 0 < count <= BULK_GENERATE_MAX:
+        return jsonify({"ok": False, "msg": f"count must be 1..{BULK_GENERATE_MAX}"}), 400
+    if not 8 <= length <= 64:
+        return jsonify({"ok": False, "msg": "length must be 8..64"}), 400
+    prefix = (data.get("prefix") or "").strip()
+    active = bool(data.get("active")) if data.get("active") is not None else True
+    now = datetime.utcnow()
+    created, misses = [], 0
+    while len(created) < count:
+        keys = {_random_key(prefix, length) for _ in range(min(BULK_CHUNK, count - len(created)))}
+        got = _insert_new_licenses(
+            [{"key": k, "credit": credit, "active": active, "created_at": now} for k in keys])
+        misses = 0 if got else misses + 1
+        if misses >= 3:
+            db.session.rollback()
+            return jsonify({"ok": False, "msg": "could not generate unique keys, use a longer length"}), 409
+        _log_activity([(lid, "create", credit, k) for lid, k in got])
+        created += got
+    _record_changes([("license", None, "reload", None)])
+    _bump_cache_version("licenses")
+    db.session.commit()
+    return jsonify({"ok": True, "created": len(created), "keys": [k for _, k in created]})
+
+def _bulk_targets(data):
+    """WHERE clauses for a bulk update: chunked `ids`, or a `filter` {q, active, all}."""
+    if data.get("ids") is not None:
+        try:
+            ids = sorted({int(i) for i in data["ids"]})
+        except (TypeError, ValueError):
+            raise ValueError("ids must be a list of integers")
+        if not ids: raise ValueError("ids is empty")
+        return [License.id.in_(ids[i:i + BULK_CHUNK]) for i in range(0, len(ids), BULK_CHUNK)]
+    flt = data.get("filter")
+    if not isinstance(flt, dict): raise ValueError("ids or filter is required")
+    conds = []
+    q = (flt.get("q") or "").strip()
+    if q: conds.append(_license_search(q))
+    if flt.get("active") is not None: conds.append(License.active == bool(flt["active"]))
+    if not conds and not flt.get("all"):
+        raise ValueError("empty filter; pass filter.all=true to update every license")
+    return [and_(*conds) if conds else true()]
+
+@bp.route("/admin_api/licenses/bulk/update", methods=["POST"])
+def adm_bulk_update_licenses():
+    """Top up credit, (de)activate or reset the MAC of many licenses at once.
+
+    Body: {"ids": [...]} or {"filter": {"q", "active", "all"}}, plus any of
+    "credit_delta" (clamped at 0 like the single-row endpoint), "active" and
+    "reset_mac". Each change logs one row per license (adjust_credit,
+    toggle, reset_mac), all in one multi-row insert per chunk.
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    try:
+        targets = _bulk_targets(data)
+        delta = int(data.get("credit_delta") or 0)
+    except (TypeError, ValueError) as e:
+        return jsonify({"ok": False, "msg": str(e)}), 400
+    values = {}
+    if delta: values["credit"] = _clamped_credit(delta)
+    if data.get("active") is not None: values["active"] = bool(data["active"])
+    if data.get("reset_mac"): values["mac_id"] = None
+    if not values:
+        return jsonify({"ok": False, "msg": "nothing to update (credit_delta, active, reset_mac)"}), 400
+    values["updated_at"] = datetime.utcnow()
+    returning = db.engine.dialect.update_returning
+    updated = 0
+    logged = []
+    if delta: logged.append(("adjust_credit", delta))
+    if "active" in values: logged.append(("toggle", int(values["active"])))
+    if "mac_id" in values: logged.append(("reset_mac", 0))
+    for where in targets:
+        stmt = update(License).where(where).values(**values).execution_options(synchronize_session=False)
+        if returning:
+            rows = db.session.execute(stmt.returning(License.id, License.key)).all()
+        else:
+            rows = db.session.execute(select(License.id, License.key).where(where)).all()
+            db.session.execute(stmt)
+        _log_activity([(lid, action, n, key) for lid, key in rows for action, n in logged])
+        updated += len(rows)
+    if updated: _record_changes([("license", None, "reload", None)])
+    _bump_cache_version("licenses")
     db.session.commit()
-    return jsonify({"ok": True, "credit": lic.credit})
+    return jsonify({"ok": True, "updated": updated})
 
 # ---------- ApiKeys ----------
-@app.route("/admin_api/apikeys", methods=["GET"])
+@bp.route("/admin_api/apikeys", methods=["GET"])
 def adm_list_apikeys():
-    items = ApiKey.query.order_by(ApiKey.id.desc()).all()
-    return jsonify([{"id": x.id, "api_key": x.api_key, "status": x.status} for x in items])
+    return _admin_page(ApiKey, ("id", "api_key", "status"))
 
-@app.route("/admin_api/apikeys", methods=["POST"])
+@bp.route("/admin_api/apikeys", methods=["POST"])
 def adm_create_apikey():
     data = request.get_json(force=True, silent=True) or {}
     api_key = (data.get("api_key") or "").strip()
@@ -266,10 +1102,13 @@ def adm_create_apikey():
         return jsonify({"ok": False, "msg": "api_key already exists"}), 409
     k = ApiKey(api_key=api_key, status=status)
     db.session.add(k)
+    db.session.flush()
+    _record_changes([("apikey", k.id, "create", _fields(k, ("id", "api_key", "status")))])
+    _bump_cache_version("apikeys")
     db.session.commit()
     return jsonify({"ok": True, "id": k.id})
 
-@app.route("/admin_api/apikeys/<int:kid>", methods=["PUT"])
+@bp.route("/admin_api/apikeys/<int:kid>", methods=["PUT"])
 def adm_update_apikey(kid):
     k = ApiKey.query.get(kid)
     if not k: return jsonify({"ok": False, "msg": "not found"}), 404
@@ -282,24 +1121,27 @@ def adm_update_apikey(kid):
         k.api_key = new_val
     if "status" in data:
         k.status = (data.get("status") or "").strip() or k.status
+    _record_changes([("apikey", kid, "update", _fields(k, ("api_key", "status")))])
+    _bump_cache_version("apikeys")
     db.session.commit()
     return jsonify({"ok": True})
 
-@app.route("/admin_api/apikeys/<int:kid>", methods=["DELETE"])
+@bp.route("/admin_api/apikeys/<int:kid>", methods=["DELETE"])
 def adm_delete_apikey(kid):
     k = ApiKey.query.get(kid)
     if not k: return jsonify({"ok": False, "msg": "not found"}), 404
     db.session.delete(k)
+    _record_changes([("apikey", kid, "delete", None)])
+    _bump_cache_version("apikeys")
     db.session.commit()
     return jsonify({"ok": True})
 
 # ---------- Voices ----------
-@app.route("/admin_api/voices", methods=["GET"])
+@bp.route("/admin_api/voices", methods=["GET"])
 def adm_list_voices():
-    items = Voice.query.order_by(Voice.id.desc()).all()
-    return jsonify([{"id": x.id, "name": x.name, "voice_id": x.voice_id, "active": x.active} for x in items])
+    return _admin_page(Voice, ("id", "name", "voice_id", "active"))
 
-@app.route("/admin_api/voices", methods=["POST"])
+@bp.route("/admin_api/voices", methods=["POST"])
 def adm_create_voice():
     data = request.get_json(force=True, silent=True) or {}
     name = (data.get("name") or "").strip()
@@ -309,41 +1151,84 @@ def adm_create_voice():
         return jsonify({"ok": False, "msg": "name and voice_id required"}), 400
     v = Voice(name=name, voice_id=voice_id, active=active)
     db.session.add(v)
+    db.session.flush()
+    _record_changes([("voice", v.id, "create", _fields(v, ("id", "name", "voice_id", "active")))])
+    _bump_cache_version("voices")
     db.session.commit()
     return jsonify({"ok": True, "id": v.id})
 
-@app.route("/admin_api/voices/upload", methods=["POST"])
+VOICE_UPLOAD_CHUNK = 500
+
+def _iter_voice_file(file):
+    """Yield (name, voice_id) from a .txt (name:voice_id), .csv or .json upload."""
+    ext = file.filename.rsplit(".", 1)[-1].lower()
+    if ext == "json":
+        items = json.load(io.TextIOWrapper(file.stream, encoding="utf-8-sig"))
+        if isinstance(items, dict):
+            items = [{"voice_id": k, "name": v} for k, v in items.items()]
+        for it in items:
+            yield str(it.get("name") or ""), str(it.get("voice_id") or "")
+        return
+    text_stream = io.TextIOWrapper(file.stream, encoding="utf-8-sig", newline="")
+    if ext == "csv":
+        for row in csv.reader(text_stream):
+            if len(row) < 2 or [c.strip().lower() for c in row[:2]] == ["name", "voice_id"]:
+                continue
+            yield row[0], row[1]
+        return
+    for line in text_stream:
+        if ':' in line:
+            yield tuple(line.split(':', 1))
+
+@bp.route("/admin_api/voices/upload", methods=["POST"])
 def adm_upload_voices():
+    """Set-based voice import: dedupe in memory, look up existing voice_ids in
+    chunks, bulk insert new ones. `update=1` also renames existing voices."""
     if 'file' not in request.files:
         return jsonify({"ok": False, "msg": "No file provided"}), 400
     file = request.files['file']
-    if not file.filename.endswith('.txt'):
-        return jsonify({"ok": False, "msg": "File must be .txt"}), 400
-    
+    if not file.filename.lower().endswith(('.txt', '.csv', '.json')):
+        return jsonify({"ok": False, "msg": "File must be .txt, .csv or .json"}), 400
+    update_names = (request.values.get("update") or "").lower() in ("1", "true", "yes", "on")
+
     try:
-        content = file.read().decode('utf-8')
-        lines = content.splitlines()
-        added = 0
-        for line in lines:
-            line = line.strip()
-            if not line or ':' not in line:
-                continue
-            name, voice_id = line.split(':', 1)
-            name = name.strip()
-            voice_id = voice_id.strip()
-            if not name or not voice_id:
+        wanted, skipped = {}, 0
+        for name, voice_id in _iter_voice_file(file):
+            name, voice_id = name.strip(), voice_id.strip()
+            if not name or not voice_id or voice_id in wanted:
+                skipped += 1
                 continue
-            if Voice.query.filter_by(voice_id=voice_id).first():
-                continue  # Skip if voice_id already exists
-            v = Voice(name=name, voice_id=voice_id, active=True)
-            db.session.add(v)
-            added += 1
+            wanted[voice_id] = name
+        added = updated = 0
+        ids = list(wanted)
+        for i in range(0, len(ids), VOICE_UPLOAD_CHUNK):
+            chunk = ids[i:i + VOICE_UPLOAD_CHUNK]
+            existing = dict(db.session.execute(
+                select(Voice.voice_id, Voice.name).where(Voice.voice_id.in_(chunk))).all())
+            new = [{"name": wanted[v], "voice_id": v, "active": True} for v in chunk if v not in existing]
+            renames = [{"b_vid": v, "b_name": wanted[v]} for v in chunk
+                       if update_names and v in existing and existing[v] != wanted[v]]
+            if new:
+                db.session.execute(insert(Voice), new)
+            if renames:
+                t = Voice.__table__
+                db.session.execute(
+                    update(t).where(t.c.voice_id == bindparam("b_vid")).values(name=bindparam("b_name")),
+                    renames)
+            added += len(new)
+            updated += len(renames)
+            skipped += len(existing) - len(renames)
+        if added or updated:
+            _record_changes([("voice", None, "reload", None)])
+            _bump_cache_version("voices")
         db.session.commit()
-        return jsonify({"ok": True, "added": added, "msg": f"Added {added} voices"})
+        return jsonify({"ok": True, "added": added, "updated": updated, "skipped": skipped,
+                        "msg": f"Added {added}, updated {updated}, skipped {skipped} voices"})
     except Exception as e:
+        db.session.rollback()
         return jsonify({"ok": False, "msg": f"Error processing file: {str(e)}"}), 400
 
-@app.route("/admin_api/voices/<int:vid>", methods=["PUT"])
+@bp.route("/admin_api/voices/<int:vid>", methods=["PUT"])
 def adm_update_voice(vid):
     v = Voice.query.get(vid)
     if not v: return jsonify({"ok": False, "msg": "not found"}), 404
@@ -351,21 +1236,44 @@ def adm_update_voice(vid):
     if "name" in data: v.name = (data.get("name") or "").strip() or v.name
     if "voice_id" in data: v.voice_id = (data.get("voice_id") or "").strip() or v.voice_id
     if "active" in data: v.active = bool(data.get("active"))
+    _record_changes([("voice", vid, "update", _fields(v, ("name", "voice_id", "active")))])
+    _bump_cache_version("voices")
     db.session.commit()
     return jsonify({"ok": True})
 
-@app.route("/admin_api/voices/<int:vid>", methods=["DELETE"])
+@bp.route("/admin_api/voices/<int:vid>", methods=["DELETE"])
 def adm_delete_voice(vid):
     v = Voice.query.get(vid)
     if not v: return jsonify({"ok": False, "msg": "not found"}), 404
     db.session.delete(v)
+    _record_changes([("voice", vid, "delete", None)])
+    _bump_cache_version("voices")
     db.session.commit()
     return jsonify({"ok": True})
 
 # ---------- Activity Logs ----------
-@app.route("/admin_api/logs", methods=["GET"])
-def adm_list_logs():
-    query = ActivityLog.query.order_by(ActivityLog.created_at.desc())
+@bp.route("/admin_api/logs/writer", methods=["GET"])
+def adm_log_writer_stats():
+    writer = _log_writer()
+    if writer is None:
+        return jsonify({"ok": True, "enabled": False})
+    return jsonify({"ok": True, "enabled": True, **writer.metrics()})
+
+@bp.cli.command("replay-failed-logs")
+def cli_replay_failed_logs():
+    """Retry dead-lettered activity logs (<segment>.failed in the spool directory)."""
+    _ensure_db()
+    app = current_app._get_current_object()
+    writer = _log_writer() or ActivityLogWriter(app, spool_dir=_log_spool_dir(app))
+    inserted, failing = writer.replay_failed()
+    click.echo(f"Inserted {inserted} activity logs, {failing} still failing")
+
+LOG_FIELDS = ("id", "license_id", "action", "char_count", "details", "created_at")
+LOG_PAGE_DEFAULT = 100
+
+def _log_filters():
+    """Build ActivityLog filters from the query string; returns (filters, error response)."""
+    filters = []
     q = (request.args.get("q") or "").strip()
     min_chars = request.args.get("min_chars", type=int)
     max_chars = request.args.get("max_chars", type=int)
@@ -374,99 +1282,273 @@ def adm_list_logs():
     date_to = (request.args.get("date_to") or "").strip()
 
     if q:
-        like = f"%{q}%"
-        query = query.join(License).filter(
-            db.or_(License.key.ilike(like), License.mac_id.ilike(like))
-        )
+        filters.append(ActivityLog.license_id.in_(select(License.id).where(_license_search(q))))
     if min_chars is not None:
-        query = query.filter(ActivityLog.char_count >= min_chars)
+        filters.append(ActivityLog.char_count >= min_chars)
     if max_chars is not None:
-        query = query.filter(ActivityLog.char_count <= max_chars)
+        filters.append(ActivityLog.char_count <= max_chars)
     if action:
-        query = query.filter(ActivityLog.action == action)
+        filters.append(ActivityLog.action == action)
     if date_from:
         try:
-            query = query.filter(ActivityLog.created_at >= datetime.fromisoformat(date_from))
+            filters.append(ActivityLog.created_at >= datetime.fromisoformat(date_from))
         except ValueError:
-            return jsonify({"ok": False, "msg": "Invalid date_from format"}), 400
+            return None, (jsonify({"ok": False, "msg": "Invalid date_from format"}), 400)
     if date_to:
         try:
-            query = query.filter(ActivityLog.created_at <= datetime.fromisoformat(date_to))
+            filters.append(ActivityLog.created_at <= datetime.fromisoformat(date_to))
+        except ValueError:
+            return None, (jsonify({"ok": False, "msg": "Invalid date_to format"}), 400)
+    return filters, None
+
+def _log_select(filters):
+    # Newest first on (created_at, id), served by ix_activity_log_created_at_id.
+    return (select(*[getattr(ActivityLog, f) for f in LOG_FIELDS]).where(*filters)
+            .order_by(ActivityLog.created_at.desc(), ActivityLog.id.desc()))
+
+@bp.route("/admin_api/logs", methods=["GET"])
+def adm_list_logs():
+    """Keyset-paginated logs. `cursor` is the X-Next-Cursor of the previous page."""
+    filters, err = _log_filters()
+    if err: return err
+    limit = min(max(request.args.get("limit", LOG_PAGE_DEFAULT, type=int), 1), ADMIN_PAGE_MAX)
+    cursor = (request.args.get("cursor") or "").strip()
+    if cursor:
+        try:
+            ts, cid = cursor.rsplit("_", 1)
+            filters.append(tuple_(ActivityLog.created_at, ActivityLog.id) < (datetime.fromisoformat(ts), int(cid)))
         except ValueError:
-            return jsonify({"ok": False, "msg": "Invalid date_to format"}), 400
-
-    items = query.limit(100).all()  # Limit to last 100 logs
-    return jsonify([{
-        "id": x.id,
-        "license_id": x.license_id,
-        "action": x.action,
-        "char_count": x.char_count,
-        "details": x.details,
-        "created_at": x.created_at.isoformat() if x.created_at else ""
-    } for x in items])
+            return jsonify({"ok": False, "msg": "Invalid cursor"}), 400
+    rows = db.session.execute(_log_select(filters).limit(limit + 1)).all()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    resp = _json_rows(LOG_FIELDS, rows)
+    if more and rows[-1].created_at:
+        resp.headers["X-Next-Cursor"] = f"{rows[-1].created_at.isoformat()}_{rows[-1].id}"
+    return resp
+
+@bp.route("/admin_api/logs/export", methods=["GET"])
+def adm_export_logs():
+    """Stream every log matching the /admin_api/logs filters as CSV or NDJSON."""
+    filters, err = _log_filters()
+    if err: return err
+    fmt = (request.args.get("format") or "csv").strip()
+    if fmt not in ("csv", "ndjson"):
+        return jsonify({"ok": False, "msg": "format must be csv or ndjson"}), 400
+
+    dump_row = current_app.json.dump_row
+
+    def lines():
+        if fmt == "csv":
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            writer.writerow(LOG_FIELDS)
+        result = db.session.execute(_log_select(filters).execution_options(yield_per=BACKUP_BATCH))
+        for row in result:
+            if fmt == "ndjson":
+                yield dump_row(LOG_FIELDS, row) + b"\n"
+            else:
+                writer.writerow([_fmt_cell(v) for v in row])
+                yield buf.getvalue()
+                buf.seek(0)
+                buf.truncate()
+        if fmt == "csv" and buf.tell():
+            yield buf.getvalue()
+
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    mimetype = "text/csv" if fmt == "csv" else "application/x-ndjson"
+    return Response(stream_with_context(_buffered(lines(), gz=False)), mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename=amulet_logs_{timestamp}.{fmt}"})
+
+@bp.cli.command("archive-logs")
+@click.option("--older-than-days", type=int, default=lambda: int(os.getenv("ACTIVITY_LOG_RETENTION_DAYS", "90")),
+              show_default="ACTIVITY_LOG_RETENTION_DAYS or 90")
+@click.option("--batch", type=int, default=10000, show_default=True)
+@click.option("--delete-only", is_flag=True, help="Delete instead of copying to activity_log_archive.")
+def cli_archive_logs(older_than_days, batch, delete_only):
+    """Move old activity logs out of the hot table in small batches."""
+    from retention import archive_logs
+    _ensure_db()
+    n = archive_logs(older_than_days, batch=batch, keep_archive=not delete_only)
+    click.echo(f"{'Deleted' if delete_only else 'Archived'} {n} activity log rows")
+
+# ---------- Usage stats ----------
+STATS_MAX_POINTS = 2000
+
+@bp.route("/admin_api/stats", methods=["GET"])
+def adm_stats():
+    """Time series, top-N licenses and totals served from the usage rollups.
+
+    granularity=hour|day (default day), date_from/date_to (ISO, default last
+    30 days), action (default debit, "all" for every action), license_id, top.
+    """
+    gran = (request.args.get("granularity") or "day").strip()
+    if gran not in ("hour", "day"):
+        return jsonify({"ok": False, "msg": "granularity must be hour or day"}), 400
+    model = UsageHourly if gran == "hour" else UsageDaily
+    try:
+        date_to = datetime.fromisoformat(request.args["date_to"]) if request.args.get("date_to") else datetime.utcnow()
+        date_from = datetime.fromisoformat(request.args["date_from"]) if request.args.get("date_from") \
+            else date_to - timedelta(days=30)
+    except ValueError:
+        return jsonify({"ok": False, "msg": "Invalid date format"}), 400
+    action = (request.args.get("action") or "debit").strip()
+    license_id = request.args.get("license_id", type=int)
+    top_n = min(max(request.args.get("top", 10, type=int), 1), 100)
+
+    filters = [model.bucket >= date_from, model.bucket <= date_to]
+    if action != "all": filters.append(model.action == action)
+    if license_id is not None: filters.append(model.license_id == license_id)
+    chars, events = func.sum(model.char_sum), func.sum(model.events)
+
+    series = db.session.execute(
+        select(model.bucket, chars, events).where(*filters)
+        .group_by(model.bucket).order_by(model.bucket).limit(STATS_MAX_POINTS)).all()
+    top = db.session.execute(
+        select(model.license_id, License.key, chars.label("chars"), events)
+        .outerjoin(License, License.id == model.license_id).where(*filters)
+        .group_by(model.license_id, License.key).order_by(func.sum(model.char_sum).desc()).limit(top_n)).all()
+    totals = db.session.execute(
+        select(model.action, chars, events).where(*filters).group_by(model.action)).all()
+    return jsonify({
+        "ok": True,
+        "granularity": gran,
+        "series": [{"bucket": b.isoformat(), "chars": int(c or 0), "count": int(n or 0)} for b, c, n in series],
+        "top": [{"license_id": lid, "key": k or "", "chars": int(c or 0), "count": int(n or 0)} for lid, k, c, n in top],
+        "totals": {a: {"chars": int(c or 0), "count": int(n or 0)} for a, c, n in totals}
+    })
+
+@bp.cli.command("rebuild-rollups")
+@click.option("--since", help="First day to rebuild (YYYY-MM-DD); default: all history.")
+@click.option("--until", help="Last day to rebuild (YYYY-MM-DD), inclusive.")
+def cli_rebuild_rollups(since, until):
+    """Backfill/repair the hourly and daily usage rollups from ActivityLog."""
+    _ensure_db()
+    n = rebuild_rollups(datetime.fromisoformat(since) if since else None,
+                        datetime.fromisoformat(until) if until else None)
+    click.echo(f"Rolled up {n} activity log rows")
 
 # ---------- Backup ----------
-@app.route("/admin_api/backup", methods=["GET"])
+# Backups are streamed: rows come from the DB in server-side cursor batches
+# and are written out as they arrive, so memory stays flat with table size.
+#   format=json   (default) one JSON document {"licenses": [...], ...}
+#   format=ndjson one {"table": ..., "row": {...}} object per line
+#   gzip=1        compress on the fly
+BACKUP_BATCH = int(os.getenv("BACKUP_BATCH", "2000"))
+BACKUP_TABLES = {
+    "licenses": (License, LICENSE_FIELDS),
+    "apikeys": (ApiKey, ("id", "api_key", "status")),
+    "voices": (Voice, ("id", "name", "voice_id", "active")),
+    "activity_logs": (ActivityLog, ("id", "license_id", "action", "char_count", "details", "created_at")),
+}
+CONFIG_FIELDS = ("latest_version", "force_update", "maintenance", "maintenance_message",
+                 "update_description", "update_links")
+
+def _iter_table_rows(name):
+    """Serialized rows of one backup table, straight from the row tuples."""
+    model, fields = BACKUP_TABLES[name]
+    stmt = select(*[getattr(model, f) for f in fields]).order_by(model.id)
+    result = db.session.execute(stmt.execution_options(yield_per=BACKUP_BATCH))
+    dump_row = current_app.json.dump_row
+    for row in result:
+        yield dump_row(fields, row)
+
+def _config_row():
+    c = Config.query.first()
+    return {f: getattr(c, f) for f in CONFIG_FIELDS} if c else {}
+
+def _backup_chunks(tables, fmt, with_config):
+    dump = current_app.json.dumpb
+    if fmt == "ndjson":
+        for name in tables:
+            head = b'{"table":' + dump(name) + b',"row":'
+            for row in _iter_table_rows(name):
+                yield head + row + b"}\n"
+        if with_config:
+            yield dump({"table": "config", "row": _config_row()}) + b"\n"
+        return
+    yield b"{"
+    for i, name in enumerate(tables):
+        yield (b"," if i else b"") + b"\n" + dump(name) + b": ["
+        sep = b"\n"
+        for row in _iter_table_rows(name):
+            yield sep + row
+            sep = b",\n"
+        yield b"]"
+    if with_config:
+        yield (b"," if tables else b"") + b'\n"config": ' + dump(_config_row())
+    yield b"\n}\n"
+
+def _buffered(chunks, gz, size=64 * 1024):
+    comp = zlib.compressobj(6, zlib.DEFLATED, 31) if gz else None
+    buf, n = [], 0
+    for chunk in chunks:
+        if isinstance(chunk, str): chunk = chunk.encode("utf-8")
+        buf.append(chunk)
+        n += len(chunk)
+        if n >= size:
+            data = b"".join(buf)
+            buf, n = [], 0
+            data = comp.compress(data) if comp else data
+            if data: yield data
+    data = b"".join(buf)
+    if comp:
+        data = comp.compress(data) + comp.flush()
+    if data: yield data
+
+def _backup_response(prefix, tables, with_config):
+    fmt = (request.args.get("format") or "json").strip()
+    if fmt not in ("json", "ndjson"):
+        return jsonify({"ok": False, "msg": "format must be json or ndjson"}), 400
+    gz = request.args.get("gzip", "").lower() in ("1", "true", "yes")
+    timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    filename = f"{prefix}_{timestamp}.{fmt}" + (".gz" if gz else "")
+    mimetype = "application/gzip" if gz else ("application/x-ndjson" if fmt == "ndjson" else "application/json")
+    body = stream_with_context(_buffered(_backup_chunks(tables, fmt, with_config), gz))
+    return Response(body, mimetype=mimetype,
+                    headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+@bp.route("/admin_api/backup", methods=["GET"])
 def adm_backup():
-    try:
-        c = Config.query.first()
-        backup = {
-            "licenses": [{
-                "id": x.id, "key": x.key, "mac_id": x.mac_id or "",
-                "credit": x.credit, "active": x.active,
-                "created_at": x.created_at.isoformat() if x.created_at else "",
-                "updated_at": x.updated_at.isoformat() if x.updated_at else ""
-            } for x in License.query.all()],
-            "apikeys": [{"id": x.id, "api_key": x.api_key, "status": x.status} for x in ApiKey.query.all()],
-            "voices": [{"id": x.id, "name": x.name, "voice_id": x.voice_id, "active": x.active} for x in Voice.query.all()],
-            "config": {
-                "latest_version": c.latest_version,
-                "force_update": c.force_update,
-                "maintenance": c.maintenance,
-                "maintenance_message": c.maintenance_message,
-                "update_description": c.update_description,
-                "update_links": c.update_links
-            } if c else {}
-        }
-        output = BytesIO()
-        output.write(json.dumps(backup, indent=2, ensure_ascii=False).encode('utf-8'))
-        output.seek(0)
-        timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-        return send_file(
-            output,
-            mimetype='application/json',
-            as_attachment=True,
-            download_name=f'amulet_backup_{timestamp}.json'
-        )
-    except Exception as e:
-        return jsonify({"ok": False, "msg": f"Backup error: {str(e)}"}), 500
+    return _backup_response("amulet_backup", list(BACKUP_TABLES), with_config=True)
 
-@app.route("/admin_api/backup/licenses", methods=["GET"])
+@bp.route("/admin_api/backup/licenses", methods=["GET"])
 def adm_backup_licenses():
+    return _backup_response("amulet_licenses_backup", ["licenses"], with_config=False)
+
+# ---------- Restore ----------
+def _restore_and_invalidate(fileobj, dry_run):
+    from restore import restore_backup  # only needed by restores; keeps worker import light
+    stats = restore_backup(fileobj, dry_run=dry_run)
+    if not dry_run:
+        _record_changes([(entity, None, "reload", None) for entity in ("license", "apikey", "voice")])
+        _bump_cache_version("voices", "config", "apikeys", "licenses")
+        db.session.commit()
+    return stats
+
+@bp.route("/admin_api/restore", methods=["POST"])
+def adm_restore():
+    """Upload a backup (multipart `file` or raw body); ?dry_run=1 only reports the diff."""
+    dry_run = request.args.get("dry_run", "").lower() in ("1", "true", "yes")
+    fileobj = request.files["file"].stream if "file" in request.files else request.stream
     try:
-        backup = {
-            "licenses": [{
-                "id": x.id, "key": x.key, "mac_id": x.mac_id or "",
-                "credit": x.credit, "active": x.active,
-                "created_at": x.created_at.isoformat() if x.created_at else "",
-                "updated_at": x.updated_at.isoformat() if x.updated_at else ""
-            } for x in License.query.all()]
-        }
-        output = BytesIO()
-        output.write(json.dumps(backup, indent=2, ensure_ascii=False).encode('utf-8'))
-        output.seek(0)
-        timestamp = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
-        return send_file(
-            output,
-            mimetype='application/json',
-            as_attachment=True,
-            download_name=f'amulet_licenses_backup_{timestamp}.json'
-        )
-    except Exception as e:
-        return jsonify({"ok": False, "msg": f"Backup error: {str(e)}"}), 500
+        stats = _restore_and_invalidate(fileobj, dry_run)
+    except (ValueError, KeyError) as e:  # RestoreError is a ValueError
+        return jsonify({"ok": False, "msg": f"Restore error: {str(e)}"}), 400
+    return jsonify({"ok": True, "dry_run": dry_run, "tables": stats})
+
+@bp.cli.command("restore-backup")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--dry-run", is_flag=True, help="Report what would change without writing.")
+def cli_restore_backup(path, dry_run):
+    """Restore a JSON/NDJSON(.gz) backup file into the configured database."""
+    _ensure_db()
+    with open(path, "rb") as f:
+        stats = _restore_and_invalidate(f, dry_run)
+    click.echo(json.dumps({"dry_run": dry_run, "tables": stats}, indent=2))
 
 # ---------- Config ----------
-@app.route("/admin_api/config", methods=["GET"])
+@bp.route("/admin_api/config", methods=["GET"])
 def adm_get_config():
     c = Config.query.first()
     if not c:
@@ -480,7 +1562,7 @@ def adm_get_config():
         "update_links": c.update_links
     })
 
-@app.route("/admin_api/config", methods=["PUT"])
+@bp.route("/admin_api/config", methods=["PUT"])
 def adm_update_config():
     c = Config.query.first()
     if not c:
@@ -493,20 +1575,103 @@ def adm_update_config():
     if "maintenance_message" in data: c.maintenance_message = str(data.get("maintenance_message") or "")
     if "update_description" in data: c.update_description = str(data.get("update_description") or "")
     if "update_links" in data:    c.update_links = str(data.get("update_links") or "")
+    _bump_cache_version("config")
     db.session.commit()
     return jsonify({"ok": True})
 
+# ==================================================
+# ================== HEALTH CHECKS =================
+# ==================================================
+# Both bypass the ORM session: /healthz never touches the DB, /readyz checks
+# out a raw pooled connection and runs SELECT 1.
+@bp.route("/healthz")
+def healthz():
+    return jsonify({"ok": True})
+
+@bp.route("/readyz")
+def readyz():
+    try:
+        with db.engine.connect() as conn:
+            conn.execute(text("SELECT 1"))
+    except Exception as e:
+        return jsonify({"ok": False, "msg": f"database unavailable: {e.__class__.__name__}"}), 503
+    return jsonify({"ok": True})
+
+# ==================================================
+# ==================== METRICS =====================
+# ==================================================
+@metrics.REGISTRY.collector
+def _runtime_metrics():
+    pool = db.engine.pool
+    if isinstance(pool, metrics.TimedQueuePool):
+        yield ("amulet_db_pool_connections", "gauge", "Pooled DB connections by state.",
+               [({"state": "checked_out"}, pool.checkedout()), ({"state": "idle"}, pool.checkedin()),
+                ({"state": "overflow"}, max(pool.overflow(), 0))])
+    st = _state()
+    lc = st.license_cache.stats()
+    yield ("amulet_license_cache_lookups_total", "counter", "License status cache lookups by result.",
+           [({"result": "hit"}, lc["hits"]), ({"result": "negative_hit"}, lc["negative_hits"]),
+            ({"result": "miss"}, lc["misses"])])
+    yield ("amulet_license_cache_hit_ratio", "gauge", "Share of license lookups answered from cache.",
+           [({}, lc["hit_ratio"])])
+    yield ("amulet_license_cache_entries", "gauge", "License status cache entries (incl. negative).",
+           [({}, lc["size"])])
+    yield ("amulet_license_cache_evictions_total", "counter", "LRU evictions from the license cache.",
+           [({}, lc["evictions"])])
+    yield ("amulet_idempotency_cache_lookups_total", "counter", "request_id lookups in the in-memory LRU.",
+           [({"result": "hit"}, st.idem_cache.hits), ({"result": "miss"}, st.idem_cache.misses)])
+    if st.rate_limiter is not None:
+        yield ("amulet_rate_limit_backend_errors_total", "counter",
+               "Rate limit checks that failed open because the backend errored.", [({}, st.rate_limiter.errors)])
+    stats = st.key_pool.stats()
+    yield ("amulet_api_key_pool", "gauge", "Upstream API keys in this worker's lease pool.",
+           [({"state": "free"}, stats["free"]), ({"state": "leased"}, stats["leased"])])
+    writer = _log_writer()
+    if writer is not None:
+        w = writer.metrics()
+        yield ("amulet_log_writer_queue_depth", "gauge", "Activity log records waiting to be flushed.",
+               [({}, w["queue_depth"])])
+        yield ("amulet_log_writer_pending_segments", "gauge", "Closed spool segments not yet flushed.",
+               [({}, w["pending_segments"])])
+        yield ("amulet_log_writer_flushed_total", "counter", "Activity log records written.",
+               [({}, w["flushed_total"])])
+        yield ("amulet_log_writer_flush_errors_total", "counter", "Failed activity log flushes.",
+               [({}, w["flush_errors"])])
+        yield ("amulet_log_writer_blocked_total", "counter", "Submits that waited on a full queue.",
+               [({}, w["blocked_total"])])
+        yield ("amulet_log_writer_dead_lettered_total", "counter",
+               "Activity log records set aside in .failed spool files.", [({}, w["dead_lettered"])])
+        yield ("amulet_log_writer_last_flush_seconds", "gauge", "Duration of the last flush.",
+               [({}, w["last_flush_ms"] / 1000.0)])
+
+@bp.route("/metrics")
+def prometheus_metrics():
+    return Response(metrics.REGISTRY.render(), mimetype="text/plain; version=0.0.4")
+
+@bp.route("/admin_api/profile", methods=["GET"])
+def adm_profile():
+    """Collapsed stacks of the slowest requests (PROFILE_SLOWEST=N); ?reset=1 clears them."""
+    if _profiler is None:
+        return jsonify({"ok": False, "msg": "Profiler disabled (set PROFILE_SLOWEST)"}), 404
+    body = _profiler.collapsed()
+    if request.args.get("reset", "").lower() in ("1", "true", "yes"):
+        _profiler.reset()
+    return Response(body, mimetype="text/plain")
+
 # ==================================================
 # ================ ADMIN UI PAGES ==================
 # ==================================================
-@app.route("/")
-@app.route("/admin")
+@bp.route("/")
+@bp.route("/admin")
 def admin_page():
     return send_from_directory('.', 'admin.html')
 
-@app.route("/<path:filename>")
+@bp.route("/<path:filename>")
 def static_files(filename):
     return send_from_directory('.', filename)
 
+app = create_app()
+
 if __name__ == "__main__":
-    app.run(port=3030, debug=True)
\ No newline at end of file
+    # Development server only; production runs `gunicorn -c gunicorn.conf.py wsgi:app`.
+    app.run(port=3030, debug=os.getenv("FLASK_DEBUG", "1") == "1")
\ No newline at end of file
@@ -0,0 +1,178 @@
+"""Concurrency stress test for the debit ledger.
+
+    python bench/concurrency.py [--mode client|http] [--threads 25] [--debits 60]
+                                [--credit 1000] [--count 1] [--retries 1]
+
+Seeds one license with --credit credits in a throwaway SQLite database (or
+BENCH_DATABASE_URL). Then --threads workers each send --debits debits of
+--count credits at the same time, each with its own request_id. Every
+successful debit is re-sent --retries times with the same request_id; the
+replay must return the stored result without charging again.
+
+When the run ends the script checks these numbers:
+
+    successes    == min(threads * debits, credit // count)
+    final credit == credit - successes * count
+    debit logs   == successes
+
+Every other debit must fail with "Insufficient credit". The script exits
+non-zero when any check fails, so it can run in CI.
+"""
+import argparse, http.client, json, os, sys, tempfile, threading, time, uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+KEY, MAC = "STRESS-0001", "mac-stress"
+
+
+def _args():
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("--mode", choices=["client", "http"], default="client")
+    p.add_argument("--threads", type=int, default=25)
+    p.add_argument("--debits", type=int, default=60, help="debits per thread")
+    p.add_argument("--credit", type=int, default=1000, help="starting credit")
+    p.add_argument("--count", type=int, default=1, help="credits per debit")
+    p.add_argument("--retries", type=int, default=1, help="replays per successful debit")
+    p.add_argument("--server", choices=["auto", "gunicorn", "dev"], default="auto")
+    return p.parse_args()
+
+
+def seed(A, opts):
+    """(Re)create the benchmark license; only rows belonging to it are deleted."""
+    from sqlalchemy import delete, select
+    from models import IdempotencyKey
+    with A.app.app_context():
+        A.init_db()
+        mine = select(A.License.id).where(A.License.key == KEY).scalar_subquery()
+        for model in (A.ActivityLog, A.UsageHourly, A.UsageDaily):
+            A.db.session.execute(delete(model).where(model.license_id == mine))
+        A.db.session.execute(delete(IdempotencyKey).where(IdempotencyKey.license_key == KEY))
+        A.db.session.execute(delete(A.License).where(A.License.key == KEY))
+        A.db.session.add(A.License(key=KEY, mac_id=MAC, credit=opts.credit, active=True))
+        A.db.session.commit()
+
+
+def totals(A):
+    from sqlalchemy import func, select
+    with A.app.app_context():
+        lic = A.License.query.filter_by(key=KEY).first()
+        logs = A.db.session.execute(
+            select(func.count()).select_from(A.ActivityLog)
+            .where(A.ActivityLog.license_id == lic.id, A.ActivityLog.action == "debit")).scalar()
+        return lic.credit, logs
+
+
+# ---------- drivers ----------
+def client_call(A):
+    client = A.app.test_client()
+
+    def call(body):
+        r = client.post("/api", data=body, content_type="application/json")
+        return r.status_code, r.get_json()
+    return call
+
+
+def http_call(port):
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+
+    def call(body):
+        conn.request("POST", "/api", body, {"Content-Type": "application/json"})
+        r = conn.getresponse()
+        return r.status, json.loads(r.read())
+    return call
+
+
+def hammer(make_call, opts):
+    """Fire every debit from --threads workers released together; returns the tallies."""
+    tally = {"ok": 0, "insufficient": 0, "replayed": 0, "bad_replay": 0, "errors": []}
+    lock, gate = threading.Lock(), threading.Barrier(opts.threads)
+
+    def worker():
+        call = make_call()
+        mine = {"ok": 0, "insufficient": 0, "replayed": 0, "bad_replay": 0, "errors": []}
+        gate.wait()
+        for _ in range(opts.debits):
+            body = json.dumps({"action": "debit", "key": KEY, "mac": MAC,
+                               "count": opts.count, "request_id": uuid.uuid4().hex})
+            try:
+                status, data = call(body)
+            except Exception as e:
+                mine["errors"].append(repr(e))
+                continue
+            if status == 200 and data.get("ok"):
+                mine["ok"] += 1
+                for _ in range(opts.retries):
+                    status2, again = call(body)
+                    good = status2 == 200 and again == {**data, "replayed": True}
+                    mine["replayed" if good else "bad_replay"] += 1
+            elif data and data.get("msg") == "Insufficient credit":
+                mine["insufficient"] += 1
+            else:
+                mine["errors"].append(f"{status} {data}")
+        with lock:
+            for k, v in mine.items():
+                tally[k] += v
+
+    threads = [threading.Thread(target=worker) for _ in range(opts.threads)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return tally
+
+
+def main():
+    opts = _args()
+    url = os.getenv("BENCH_DATABASE_URL")
+    tmp = None
+    if not url:
+        tmp = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+        url = f"sqlite:///{tmp.name}"
+    os.environ["DATABASE_URL"] = url
+    os.environ.setdefault("DB_AUTO_INIT", "0")
+    os.environ.setdefault("RATE_LIMIT", "0")  # every client shares 127.0.0.1
+    os.environ.setdefault("ACTIVITY_LOG_ASYNC", "0")  # count logs right after the run
+    import app as A
+
+    seed(A, opts)
+    attempts = opts.threads * opts.debits
+    t0 = time.perf_counter()
+    if opts.mode == "client":
+        tally = hammer(lambda: client_call(A), opts)
+    else:
+        from load import start_server
+        proc, port, kind = start_server(url, opts)
+        try:
+            tally = hammer(lambda: http_call(port), opts)
+        finally:
+            proc.terminate()
+            proc.wait(10)
+    elapsed = time.perf_counter() - t0
+
+    credit, logs = totals(A)
+    want = min(attempts, opts.credit // opts.count)
+    checks = [
+        ("successes", tally["ok"], want),
+        ("rejections", tally["insufficient"], attempts - want),
+        ("final credit", credit, opts.credit - want * opts.count),
+        ("debit logs", logs, want),
+        ("replays", tally["replayed"], want * opts.retries),
+        ("errors", len(tally["errors"]), 0),
+    ]
+    print(f"{attempts} debits from {opts.threads} threads in {elapsed:.2f}s ({opts.mode})")
+    ok = True
+    for name, got, expected in checks:
+        good = got == expected
+        ok &= good
+        print(f"{'ok  ' if good else 'FAIL'} {name:<13} {got:>8}  (expected {expected})")
+    for err in tally["errors"][:5]:
+        print("  error:", err)
+
+    if tmp:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(tmp.name + suffix):
+                os.unlink(tmp.name + suffix)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+"""Load test for the public /api dispatcher.
+
+    python bench/load.py [--mode client|http|both] [--duration 5] [--concurrency 32]
+                         [--licenses 100000] [--logs 1000000] [--json out.json]
+                         [--compare baseline.json]
+
+Seeds a throwaway SQLite database (or BENCH_DATABASE_URL, e.g. a local
+PostgreSQL container) with licenses, API keys, voices and activity logs.
+Then it drives each action for --duration seconds from --concurrency threads:
+
+    client  in-process through the Flask test client (app cost only)
+    http    against a real server subprocess over keep-alive connections
+            (gunicorn -c gunicorn.conf.py when installed, else the dev server)
+
+Seeding wipes the benchmark tables, so a BENCH_DATABASE_URL holding
+licenses the benchmark did not create is refused unless --force is given.
+Rate limiting is off unless RATE_LIMIT=1 is set, since every client
+shares one IP. For every (mode, action) it prints the throughput and p50/p95/p99 latency.
+--json writes the same results in machine-readable form. --compare loads an
+earlier --json file and exits non-zero when throughput falls, or p95 rises,
+by more than --tolerance (default 20%).
+"""
+import argparse, http.client, json, os, random, socket, subprocess, sys, tempfile, threading, time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+ACTIONS = ["check", "debit", "refund", "next_api_key", "get_voices", "get_config"]
+SEED_BATCH = 50000
+
+
+def _args():
+    p = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    p.add_argument("--mode", choices=["client", "http", "both"], default="both")
+    p.add_argument("--actions", default=",".join(ACTIONS))
+    p.add_argument("--duration", type=float, default=5.0, help="seconds per action")
+    p.add_argument("--warmup", type=float, default=0.5, help="seconds per action before measuring")
+    p.add_argument("--concurrency", type=int, default=32)
+    p.add_argument("--licenses", type=int, default=100000)
+    p.add_argument("--apikeys", type=int, default=200)
+    p.add_argument("--voices", type=int, default=500)
+    p.add_argument("--logs", type=int, default=1000000)
+    p.add_argument("--server", choices=["auto", "gunicorn", "dev"], default="auto")
+    p.add_argument("--json", help="write results to this file")
+    p.add_argument("--compare", help="baseline --json file to check for regressions")
+    p.add_argument("--tolerance", type=float, default=0.2)
+    p.add_argument("--force", action="store_true", help="wipe a BENCH_DATABASE_URL that holds other data")
+    return p.parse_args()
+
+
+# ---------- seeding ----------
+def refuse_foreign_licenses(A, prefix, force):
+    """Exit unless every license in BENCH_DATABASE_URL was created by a benchmark."""
+    from sqlalchemy import func, select
+    if force or not os.getenv("BENCH_DATABASE_URL"):
+        return
+    n = A.db.session.execute(select(func.count()).select_from(A.License)
+                             .where(A.License.key.notlike(prefix + "%"))).scalar()
+    if n:
+        raise SystemExit(f"BENCH_DATABASE_URL holds {n} licenses not created by this benchmark "
+                         "and seeding would delete them; pass --force to run anyway")
+
+
+def seed(A, opts):
+    """Fill the database unless it already holds the requested volumes; returns the dialect."""
+    from sqlalchemy import func, insert, select
+    with A.app.app_context():
+        A.init_db()
+        refuse_foreign_licenses(A, "BENCH-", opts.force)
+        have = A.db.session.execute(select(func.count()).select_from(A.License)).scalar()
+        if have == opts.licenses:
+            return A.db.engine.dialect.name
+        for model in (A.ActivityLog, A.UsageHourly, A.UsageDaily, A.License, A.ApiKey, A.Voice):
+            A.db.session.execute(model.__table__.delete())
+        for start in range(0, opts.licenses, SEED_BATCH):
+            A.db.session.execute(insert(A.License), [
+                {"key": f"BENCH-{i:08d}", "mac_id": f"mac-{i}", "credit": 10 ** 9, "active": True}
+                for i in range(start, min(start + SEED_BATCH, opts.licenses))])
+        A.db.session.execute(insert(A.ApiKey), [
+            {"api_key": f"sk-bench-{i:06d}", "status": "active"} for i in range(opts.apikeys)])
+        A.db.session.execute(insert(A.Voice), [
+            {"name": f"Voice {i}", "voice_id": f"v{i:06d}", "active": True} for i in range(opts.voices)])
+        first_id = A.db.session.execute(select(func.min(A.License.id))).scalar() or 1
+        rnd, t0 = random.Random(1), datetime.utcnow() - timedelta(days=90)
+        for start in range(0, opts.logs, SEED_BATCH):
+            A.db.session.execute(insert(A.ActivityLog), [{
+                "license_id": first_id + rnd.randrange(opts.licenses),
+                "action": "debit", "char_count": rnd.randrange(1, 5000),
+                "details": "bench",
+                "created_at": t0 + timedelta(seconds=i * 90 * 86400 // max(opts.logs, 1)),
+            } for i in range(start, min(start + SEED_BATCH, opts.logs))])
+        A._bump_cache_version("voices", "config", "apikeys")
+        A.db.session.commit()
+        return A.db.engine.dialect.name
+
+
+def _body(action, rnd, licenses):
+    i = rnd.randrange(licenses)
+    req = {"action": action, "key": f"BENCH-{i:08d}", "mac": f"mac-{i}"}
+    if action in ("debit", "refund"):
+        req["count"] = 1
+    return json.dumps(req)
+
+
+# ---------- drivers ----------
+def _drive(make_call, action, opts):
+    """Run `concurrency` threads calling make_call() and collect latencies."""
+    samples, errors, lock = [], [0], threading.Lock()
+    start = time.perf_counter()
+    measure_from = start + opts.warmup
+    stop = measure_from + opts.duration
+
+    def worker(seed_):
+        call = make_call()
+        rnd = random.Random(seed_)
+        mine, err = [], 0
+        while True:
+            body = _body(action, rnd, opts.licenses)
+            t0 = time.perf_counter()
+            if t0 >= stop:
+                break
+            try:
+                ok = call(body)
+            except Exception:
+                ok = False
+            t1 = time.perf_counter()
+            if t0 >= measure_from:
+                mine.append(t1 - t0)
+                err += not ok
+        with lock:
+            samples.extend(mine)
+            errors[0] += err
+
+    threads = [threading.Thread(target=worker, args=(n,)) for n in range(opts.concurrency)]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    return _summary(action, samples, errors[0], opts.duration)
+
+
+def _summary(action, samples, errors, duration):
+    samples.sort()
+    pct = lambda q: round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 3) if samples else None
+    return {"action": action, "requests": len(samples), "errors": errors,
+            "rps": round(len(samples) / duration, 1),
+            "p50_ms": pct(0.50), "p95_ms": pct(0.95), "p99_ms": pct(0.99), "max_ms": pct(1.0)}
+
+
+def run_client(A, action, opts):
+    def make_call():
+        client = A.app.test_client()
+
+        def call(body):
+            r = client.post("/api", data=body, content_type="application/json")
+            return r.status_code == 200 and r.get_json().get("ok", False)
+        return call
+    return _drive(make_call, action, opts)
+
+
+def run_http(port, action, opts):
+    def make_call():
+        conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+
+        def call(body):
+            conn.request("POST", "/api", body, {"Content-Type": "application/json"})
+            r = conn.getresponse()
+            data = r.read()
+            return r.status == 200 and json.loads(data).get("ok", False)
+        return call
+    return _drive(make_call, action, opts)
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(url, opts):
+    port = _free_port()
+    env = dict(os.environ, DATABASE_URL=url, PORT=str(port), DB_AUTO_INIT="0", FLASK_DEBUG="0")
+    kind = opts.server
+    if kind == "auto":
+        try:
+            import gunicorn  # noqa: F401
+            kind = "gunicorn"
+        except ImportError:
+            kind = "dev"
+    if kind == "gunicorn":
+        cmd = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py", "--bind", f"127.0.0.1:{port}", "wsgi:app"]
+    else:
+        cmd = [sys.executable, "-m", "flask", "--app", "app", "run", "--port", str(port), "--with-threads"]
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=1)
+            conn.request("GET", "/readyz")
+            if conn.getresponse().status == 200:
+                return proc, port, kind
+        except OSError:
+            time.sleep(0.2)
+    proc.kill()
+    raise SystemExit(f"{kind} server did not become ready on port {port}")
+
+
+# ---------- reporting ----------
+def _print(mode, r):
+    print(f"{mode:<7} {r['action']:<13} {r['rps']:>9.1f} req/s  p50 {r['p50_ms']:>8} ms  "
+          f"p95 {r['p95_ms']:>8} ms  p99 {r['p99_ms']:>8} ms  errors {r['errors']}")
+
+
+def compare(results, path, tolerance):
+    with open(path) as f:
+        base = {(r["mode"], r["action"]): r for r in json.load(f)["results"]}
+    failures = []
+    for r in results:
+        b = base.get((r["mode"], r["action"]))
+        if not b or not r["requests"]:
+            continue
+        if r["rps"] < b["rps"] * (1 - tolerance):
+            failures.append(f"{r['mode']}/{r['action']}: {b['rps']} -> {r['rps']} req/s")
+        if b["p95_ms"] and r["p95_ms"] > b["p95_ms"] * (1 + tolerance):
+            failures.append(f"{r['mode']}/{r['action']}: p95 {b['p95_ms']} -> {r['p95_ms']} ms")
+    for line in failures:
+        print("REGRESSION", line)
+    return not failures
+
+
+def main():
+    opts = _args()
+    url = os.getenv("BENCH_DATABASE_URL")
+    tmp = None
+    if not url:
+        tmp = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+        url = f"sqlite:///{tmp.name}"
+    os.environ["DATABASE_URL"] = url
+    os.environ.setdefault("DB_AUTO_INIT", "0")
+    os.environ.setdefault("RATE_LIMIT", "0")  # every client shares 127.0.0.1
+    import app as A
+
+    t0 = time.perf_counter()
+    dialect = seed(A, opts)
+    print(f"seeded {opts.licenses} licenses, {opts.logs} logs in {time.perf_counter() - t0:.1f}s ({dialect})")
+    actions = [a for a in opts.actions.split(",") if a]
+    results = []
+    if opts.mode in ("client", "both"):
+        for action in actions:
+            r = dict(run_client(A, action, opts), mode="client")
+            _print("client", r)
+            results.append(r)
+    if opts.mode in ("http", "both"):
+        proc, port, kind = start_server(url, opts)
+        try:
+            for action in actions:
+                r = dict(run_http(port, action, opts), mode="http")
+                _print("http", r)
+                results.append(r)
+        finally:
+            proc.terminate()
+            proc.wait(10)
+
+    ok = True
+    if opts.json:
+        with open(opts.json, "w") as f:
+            json.dump({"meta": {
+                "dialect": dialect, "server": opts.server,
+                "concurrency": opts.concurrency, "duration": opts.duration,
+                "licenses": opts.licenses, "logs": opts.logs, "cpus": os.cpu_count(),
+                "timestamp": datetime.utcnow().isoformat(),
+            }, "results": results}, f, indent=2)
+    if opts.compare:
+        ok = compare(results, opts.compare, opts.tolerance)
+    if tmp:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(tmp.name + suffix):
+                os.unlink(tmp.name + suffix)
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Admin license search latency: indexed prefix/trigram path vs ILIKE '%q%'.
+
+    python bench/search.py [10000,100000,1000000] [--force]
+
+Seeds a throwaway SQLite database per size (or uses BENCH_DATABASE_URL) and
+prints the median latency of each query shape over a few search terms.
+Seeding replaces every license, so a BENCH_DATABASE_URL holding licenses
+this script did not create is refused unless --force is given.
+"""
+import os, sys, random, string, statistics, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+ARGS = [a for a in sys.argv[1:] if a != "--force"]
+FORCE = "--force" in sys.argv[1:]
+SIZES = [int(x) for x in (ARGS[0] if ARGS else "10000,100000,1000000").split(",")]
+TERMS = ["AB12", "ff:0", "KEY-9", "zz"]
+REPEAT = 20
+
+
+def _rand_key(rnd):
+    return "KEY-" + "".join(rnd.choices(string.ascii_uppercase + string.digits, k=16))
+
+
+def _rand_mac(rnd):
+    return ":".join(f"{rnd.randrange(256):02x}" for _ in range(6))
+
+
+def _time(fn):
+    samples = []
+    for _ in range(REPEAT):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(samples)
+
+
+def run(size):
+    url = os.getenv("BENCH_DATABASE_URL")
+    tmp = None
+    if not url:
+        tmp = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+        url = f"sqlite:///{tmp.name}"
+    os.environ["DATABASE_URL"] = url
+    for mod in [m for m in sys.modules if m in ("app", "models")]:
+        del sys.modules[mod]
+    import app as A
+    from sqlalchemy import insert, select
+    from load import refuse_foreign_licenses
+    rnd = random.Random(size)
+    with A.app.app_context():
+        A.init_db()
+        refuse_foreign_licenses(A, "KEY-", FORCE)
+        A.db.session.execute(A.License.__table__.delete())
+        batch = 50000
+        for start in range(0, size, batch):
+            rows = [{"key": _rand_key(rnd), "mac_id": _rand_mac(rnd), "credit": 0, "active": True}
+                    for _ in range(min(batch, size - start))]
+            A.db.session.execute(insert(A.License), rows)
+        A.db.session.commit()
+
+        def scan(q):
+            like = f"%{q}%"
+            stmt = select(A.License.id).where(A.db.or_(A.License.key.ilike(like), A.License.mac_id.ilike(like)))
+            A.db.session.execute(stmt.order_by(A.License.id.desc()).limit(200)).all()
+
+        def indexed(q):
+            stmt = select(A.License.id).where(A._license_search(q))
+            A.db.session.execute(stmt.order_by(A.License.id.desc()).limit(200)).all()
+
+        old = statistics.median(_time(lambda: scan(t)) for t in TERMS)
+        new = statistics.median(_time(lambda: indexed(t)) for t in TERMS)
+    print(f"{size:>9} licenses  ilike-scan {old:8.2f} ms  indexed {new:8.2f} ms  ({old / max(new, 1e-6):.1f}x)")
+    if tmp:
+        os.unlink(tmp.name)
+
+
+if __name__ == "__main__":
+    for n in SIZES:
+        run(n)
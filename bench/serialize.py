@@ -0,0 +1,70 @@
+"""JSON encode/decode microbenchmarks: stdlib provider vs orjson provider.
+
+    python bench/serialize.py
+
+No database is needed; rows are synthetic tuples shaped like the real
+selects. Prints microseconds per operation for:
+
+    api_roundtrip   parse a /api body + build the JSON response
+    voices_payload  serialize the get_voices payload (500 voices)
+    admin_page      1000 license rows -> response body (old: dict + _fmt_cell + jsonify)
+    backup_rows     one backup row -> bytes (old: dict + json.dumps)
+
+"before" is only shown where the old code path differed from the std
+provider; for the other rows std is what ran before.
+"""
+import json, os, sys, timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import app as A
+from jsonprovider import OrjsonProvider, StdJSONProvider, orjson
+
+FIELDS = A.LICENSE_FIELDS
+ROWS = [(i, f"KEY-{i:012d}", None if i % 3 else f"aa:bb:cc:{i % 256:02x}", i * 3, True,
+         datetime(2024, 1, 1, 12, 0, i % 60, i), None if i % 2 else datetime(2024, 6, 1, 8, 30, 0, i))
+        for i in range(1000)]
+VOICES = {"ok": True, "voices": [{"name": f"Voice {i}", "voice_id": f"v{i:06d}"} for i in range(500)]}
+BODY = b'{"action":"debit","key":"KEY-000000001234","mac":"aa:bb:cc:dd:ee:ff","count":250}'
+
+
+def _old_page():
+    return A.app.json.response([{n: A._fmt_cell(v) for n, v in zip(FIELDS, r)} for r in ROWS]).get_data()
+
+
+def _old_row(r):
+    return json.dumps({n: A._fmt_cell(v) for n, v in zip(FIELDS, r)}, ensure_ascii=False).encode("utf-8")
+
+
+def _us(fn, number):
+    return min(timeit.repeat(fn, number=number, repeat=5)) / number * 1e6
+
+
+def run(provider):
+    A.app.json = provider
+    with A.app.app_context():
+        return {
+            "api_roundtrip": _us(lambda: provider.response(
+                {"ok": True, "debited": provider.loads(BODY)["count"], "credit": 1000}).get_data(), 5000),
+            "voices_payload": _us(lambda: provider.dumpb(VOICES), 200),
+            "admin_page": _us(lambda: provider.dump_rows(FIELDS, ROWS), 50),
+            "backup_rows": _us(lambda: [provider.dump_row(FIELDS, r) for r in ROWS], 50) / len(ROWS),
+        }
+
+
+if __name__ == "__main__":
+    std = StdJSONProvider(A.app)
+    A.app.json = std
+    with A.app.app_context():
+        old = {
+            "admin_page": _us(_old_page, 50),
+            "backup_rows": _us(lambda: [_old_row(r) for r in ROWS], 50) / len(ROWS),
+        }
+    results = {"std": run(std)}
+    if orjson is not None:
+        results["orjson"] = run(OrjsonProvider(A.app))
+    print(f"{'us/op':<16}{'before':>10}" + "".join(f"{k:>10}" for k in results))
+    for name in results["std"]:
+        before = f"{old[name]:10.1f}" if name in old else f"{'-':>10}"
+        print(f"{name:<16}{before}" + "".join(f"{r[name]:10.1f}" for r in results.values()))
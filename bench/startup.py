@@ -0,0 +1,72 @@
+"""Worker cold-start time: importing the app and serving its first request.
+
+    python bench/startup.py [runs] [--baseline PATH]
+
+Every sample is a fresh interpreter (as a gunicorn worker or test process
+would be) against a throwaway SQLite database that already has the schema,
+or BENCH_DATABASE_URL. Reported per scenario, in ms (median / min):
+
+    import          `import app`
+    first_request   import + one /api get_config through the test client
+                    (includes the lazy one-shot schema check, DB_AUTO_INIT=1)
+    first_request_noinit  same with DB_AUTO_INIT=0 (schema made by `flask init-db`)
+
+--baseline PATH times another checkout (e.g. a `git worktree` of an older
+revision) with the same scenarios for comparison.
+"""
+import os, statistics, subprocess, sys, tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RUNS = int(sys.argv[1]) if len(sys.argv) > 1 and sys.argv[1].isdigit() else 15
+BASELINE = sys.argv[sys.argv.index("--baseline") + 1] if "--baseline" in sys.argv else None
+
+PROBE = """
+import sys, time
+sys.path.insert(0, {root!r})
+t0 = time.perf_counter()
+import app as A
+t1 = time.perf_counter()
+if {request}:
+    A.app.test_client().post("/api", json={{"action": "get_config"}})
+print((t1 - t0) * 1000, (time.perf_counter() - t0) * 1000)
+"""
+
+SCENARIOS = [
+    ("import", False, {}),
+    ("first_request", True, {"DB_AUTO_INIT": "1"}),
+    ("first_request_noinit", True, {"DB_AUTO_INIT": "0"}),
+]
+
+
+def _sample(root, request, env):
+    out = subprocess.run([sys.executable, "-c", PROBE.format(root=root, request=request)],
+                         env=env, cwd=root, capture_output=True, text=True, check=True).stdout
+    imp, total = map(float, out.split())
+    return total if request else imp
+
+
+def run(root, url):
+    env = dict(os.environ, DATABASE_URL=url, ACTIVITY_LOG_ASYNC="0")
+    # Create the schema once up front so every scenario starts from a deployed DB.
+    subprocess.run([sys.executable, "-c", PROBE.format(root=root, request=True)],
+                   env=dict(env, DB_AUTO_INIT="1"), cwd=root, capture_output=True, check=True)
+    print(root)
+    for name, request, extra in SCENARIOS:
+        samples = [_sample(root, request, dict(env, **extra)) for _ in range(RUNS)]
+        print(f"  {name:<22} median {statistics.median(samples):8.1f} ms   min {min(samples):8.1f} ms")
+
+
+if __name__ == "__main__":
+    url = os.getenv("BENCH_DATABASE_URL")
+    tmp = None
+    if not url:
+        tmp = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+        url = f"sqlite:///{tmp.name}"
+    try:
+        for root in [BASELINE, ROOT] if BASELINE else [ROOT]:
+            run(os.path.abspath(root), url)
+    finally:
+        if tmp:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(tmp.name + suffix):
+                    os.unlink(tmp.name + suffix)
@@ -0,0 +1,104 @@
+"""Admin change feed: compact (entity, id, op, fields) events numbered by seq.
+
+Writers call record() inside their own transaction, so an event becomes
+visible exactly when the change it describes commits. Readers ask for
+everything after the last seq they saw.
+
+Ops are "create", "update", "delete", "debit", "refund" and "batch" (fields
+carry the new values), plus "reload" with no id for bulk changes where a
+client should simply refetch the table.
+
+Seqs come from the table's autoincrement, which concurrent transactions may
+commit out of order. fetch() therefore stops at a gap in the sequence until
+it is SETTLE_SECONDS old; a gap that is still missing by then belonged to a
+rolled-back transaction and is skipped.
+"""
+import json, threading
+from datetime import datetime, timedelta
+from sqlalchemy import event, func, insert, select
+from sqlalchemy.orm import Session
+from jsonprovider import iso_default
+from models import db, ChangeEvent
+from retention import DELETE_BATCH, delete_older_than
+
+SETTLE_SECONDS = 2.0
+FETCH_LIMIT = 500
+
+# Wakes long-polls in this worker as soon as a local transaction with
+# events commits; other workers' events are picked up by polling.
+_committed = threading.Condition()
+
+
+def record(entries):
+    """Insert (entity, entity_id, op, fields or None) entries in the current transaction."""
+    if not entries:
+        return
+    now = datetime.utcnow()
+    db.session.execute(insert(ChangeEvent), [{
+        "entity": entity, "entity_id": eid, "op": op, "created_at": now,
+        "data": json.dumps(fields, default=iso_default, separators=(",", ":")) if fields else None,
+    } for entity, eid, op, fields in entries])
+    db.session.info["changes_recorded"] = True
+
+
+@event.listens_for(Session, "after_commit")
+def _notify(session):
+    if session.info.pop("changes_recorded", None):
+        with _committed:
+            _committed.notify_all()
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget(session):
+    session.info.pop("changes_recorded", None)
+
+
+def wait(timeout):
+    """Sleep until a local commit records events or `timeout` seconds pass."""
+    if timeout > 0:
+        with _committed:
+            _committed.wait(timeout)
+
+
+def head():
+    return db.session.execute(select(func.max(ChangeEvent.id))).scalar() or 0
+
+
+def fetch(since, limit=FETCH_LIMIT):
+    """Return (reset, last, events) for events after `since`.
+
+    reset is True when `since` is no longer covered by the feed (pruned, or
+    from a different database); the client should refetch everything and
+    continue from `last`.
+    """
+    rows = db.session.execute(
+        select(ChangeEvent.id, ChangeEvent.entity, ChangeEvent.entity_id, ChangeEvent.op,
+               ChangeEvent.data, ChangeEvent.created_at)
+        .where(ChangeEvent.id > since).order_by(ChangeEvent.id).limit(limit)).all()
+    if not rows:
+        last = head()
+        return (True, last, []) if last < since else (False, since, [])
+    expected = since + 1
+    # A client starting from 0 simply gets everything; only a real cursor
+    # can have been pruned away.
+    if since and rows[0].id != expected:
+        oldest = db.session.execute(select(func.min(ChangeEvent.id))).scalar()
+        if oldest > expected:
+            return True, head(), []
+    # The gap hold-back applies to every cursor, 0 included: event 1 may
+    # still be uncommitted while event 2 is already visible.
+    settled = datetime.utcnow() - timedelta(seconds=SETTLE_SECONDS)
+    events, last = [], since
+    for r in rows:
+        if r.id != expected and r.created_at > settled:
+            break
+        events.append({"seq": r.id, "entity": r.entity, "id": r.entity_id, "op": r.op,
+                       "data": json.loads(r.data) if r.data else {}})
+        last = expected = r.id
+        expected += 1
+    return False, last, events
+
+
+def prune(older_than_hours, batch=DELETE_BATCH, max_batches=None):
+    """Delete events older than the cutoff, `batch` rows per transaction. Returns rows deleted."""
+    return delete_older_than(ChangeEvent, datetime.utcnow() - timedelta(hours=older_than_hours), batch, max_batches)
@@ -0,0 +1,14 @@
+"""Dialect-specific INSERT for the ON CONFLICT upserts shared by several modules."""
+from models import db
+
+
+def dialect_insert(model):
+    """INSERT with on_conflict_do_* on PostgreSQL/SQLite, None on other dialects."""
+    name = db.engine.dialect.name
+    if name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    elif name == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+    return insert(model)
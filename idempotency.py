@@ -0,0 +1,78 @@
+"""Idempotency store for ledger requests that carry a client `request_id`.
+
+The first successful result for a (license key, request_id) pair is stored
+in the idempotency_key table, in the same transaction as the ledger write,
+so a result exists exactly when the write committed. Retries get that
+result back without touching License. A per-worker LRU in front keeps
+replays off the database; misses are one lookup on the unique index.
+
+Each result carries a fingerprint of the request body, so a request_id
+reused for a different request is rejected instead of replayed. Results
+are kept for at least `ttl` seconds: LRU entries expire on their own and
+prune() deletes older rows in small batches.
+"""
+import hashlib, json, threading, time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from sqlalchemy import insert, select
+from models import db, IdempotencyKey
+from retention import DELETE_BATCH, delete_older_than
+
+
+def fingerprint(data):
+    """Short stable hash of a request body, ignoring its request_id."""
+    body = {k: v for k, v in data.items() if k != "request_id"}
+    raw = json.dumps(body, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=8).hexdigest()
+
+
+class ResultCache:
+    """Bounded LRU of (license key, request_id) -> (fingerprint, response)."""
+
+    def __init__(self, size=100000, ttl=86400.0):
+        self.size = size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # (key, request_id) -> (expires_at, fingerprint, response)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, request_id):
+        now = time.monotonic()
+        with self._lock:
+            ent = self._entries.get((key, request_id))
+            if ent is None or ent[0] <= now:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((key, request_id))
+            self.hits += 1
+            return ent[1], ent[2]
+
+    def put(self, key, request_id, fp, response, age=0.0):
+        with self._lock:
+            self._entries[(key, request_id)] = (time.monotonic() + self.ttl - age, fp, response)
+            self._entries.move_to_end((key, request_id))
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+def lookup(key, request_id):
+    """Stored (fingerprint, response dict, age seconds) or None."""
+    row = db.session.execute(
+        select(IdempotencyKey.fingerprint, IdempotencyKey.response, IdempotencyKey.created_at)
+        .where(IdempotencyKey.license_key == key, IdempotencyKey.request_id == request_id)).first()
+    if row is None:
+        return None
+    return row[0], json.loads(row[1]), (datetime.utcnow() - row[2]).total_seconds()
+
+
+def save(key, request_id, fp, response):
+    """Insert the result in the current transaction; IntegrityError if a retry got there first."""
+    db.session.execute(insert(IdempotencyKey).values(
+        license_key=key, request_id=request_id, fingerprint=fp,
+        response=json.dumps(response, separators=(",", ":")), created_at=datetime.utcnow()))
+
+
+def prune(ttl, batch=DELETE_BATCH, max_batches=None):
+    """Delete rows older than `ttl` seconds, `batch` rows per transaction. Returns rows deleted."""
+    return delete_older_than(IdempotencyKey, datetime.utcnow() - timedelta(seconds=ttl), batch, max_batches)
@@ -0,0 +1,89 @@
+"""Flask JSON providers: the stdlib one plus an orjson-backed fast path.
+
+Both add helpers used by the hot and bulk endpoints:
+
+    dumpb(obj)             compact UTF-8 bytes, for pre-serialized payloads
+    dump_rows(names, rows) row tuples -> JSON array of objects, None as ""
+                           and datetimes as ISO 8601 (the admin table format)
+    dump_row(names, row)   one such object, for streamed exports
+
+JSON_PROVIDER=auto (default) picks orjson when it is installed.
+"""
+import json
+from datetime import date, datetime
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # optional speed-up
+    orjson = None
+
+
+def iso_default(o):
+    """json `default=` hook: datetimes and dates as ISO 8601."""
+    if isinstance(o, (datetime, date)):
+        return o.isoformat()
+    raise TypeError(f"Object of type {o.__class__.__name__} is not JSON serializable")
+
+
+def _row_dict(names, r):
+    return dict(zip(names, ["" if v is None else v for v in r] if None in r else r))
+
+
+def _row_dicts(names, rows):
+    return [_row_dict(names, r) for r in rows]
+
+
+class StdJSONProvider(DefaultJSONProvider):
+    def dumpb(self, obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":"), default=self.default).encode("utf-8")
+
+    def dump_rows(self, names, rows):
+        return json.dumps(_row_dicts(names, rows), ensure_ascii=False, separators=(",", ":"),
+                          default=iso_default).encode("utf-8")
+
+    def dump_row(self, names, row):
+        return json.dumps(_row_dict(names, row), ensure_ascii=False, separators=(",", ":"),
+                          default=iso_default).encode("utf-8")
+
+
+class OrjsonProvider(StdJSONProvider):
+    """orjson for request bodies and responses.
+
+    Keys are not sorted, and non-ASCII is sent as UTF-8 rather than escaped.
+    Datetimes passed to jsonify keep Flask's HTTP-date format; dump_rows
+    emits ISO 8601, which for naive datetimes matches isoformat().
+    """
+
+    OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME if orjson else 0
+
+    def dumps(self, obj, **kwargs):
+        return self.dumpb(obj).decode("utf-8")
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def dumpb(self, obj):
+        return orjson.dumps(obj, default=self.default, option=self.OPTIONS)
+
+    def dump_rows(self, names, rows):
+        return orjson.dumps(_row_dicts(names, rows), default=iso_default, option=orjson.OPT_NON_STR_KEYS)
+
+    def dump_row(self, names, row):
+        return orjson.dumps(_row_dict(names, row), default=iso_default, option=orjson.OPT_NON_STR_KEYS)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        option = self.OPTIONS | orjson.OPT_APPEND_NEWLINE
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            option |= orjson.OPT_INDENT_2
+        return self._app.response_class(orjson.dumps(obj, default=self.default, option=option),
+                                        mimetype=self.mimetype)
+
+
+def make_provider(app, choice="auto"):
+    if choice == "orjson" and orjson is None:
+        raise RuntimeError("JSON_PROVIDER=orjson but the orjson package is not installed")
+    if choice in ("auto", "orjson") and orjson is not None:
+        return OrjsonProvider(app)
+    return StdJSONProvider(app)
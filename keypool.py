@@ -0,0 +1,90 @@
+import threading, time
+from collections import OrderedDict, deque
+
+
+class ApiKeyPool:
+    """In-memory lease pool over the active upstream API keys.
+
+    Keys are handed out least-recently-leased first. Every lease lasts
+    `lease_seconds`; because the duration is fixed, expiries come due in
+    lease order and a FIFO is enough to reclaim them, keeping lease/release
+    O(1) amortized. When every key is leased the oldest lease is shared
+    rather than failing the caller.
+    """
+
+    def __init__(self, lease_seconds=300):
+        self.lease_seconds = lease_seconds
+        self.version = None
+        self.checked_at = 0.0
+        self._lock = threading.Lock()
+        self._keys = {}              # id -> api_key
+        self._ids = {}               # api_key -> id
+        self._free = OrderedDict()   # id -> None, least recently leased first
+        self._leased = {}            # id -> (holder, until)
+        self._expiry = deque()       # (until, id) in lease order
+
+    def sync(self, rows, version=None):
+        """Rebuild from (id, api_key) rows of active keys, keeping live leases."""
+        with self._lock:
+            keys = dict(rows)
+            free = OrderedDict((kid, None) for kid in keys if kid not in self._free and kid not in self._leased)
+            free.update((kid, None) for kid in self._free if kid in keys)
+            self._keys = keys
+            self._ids = {v: k for k, v in keys.items()}
+            self._free = free
+            self._leased = {kid: lease for kid, lease in self._leased.items() if kid in keys}
+            self._expiry = deque(e for e in self._expiry if e[1] in self._leased)
+            self.version = version
+            self.checked_at = time.monotonic()
+
+    def _reclaim(self, now):
+        while self._expiry and self._expiry[0][0] <= now:
+            until, kid = self._expiry.popleft()
+            lease = self._leased.get(kid)
+            if lease is not None and lease[1] == until:
+                del self._leased[kid]
+                self._free[kid] = None
+
+    def lease(self, holder=""):
+        """Return (api_key, until) or None when the pool is empty."""
+        with self._lock:
+            if not self._keys:
+                return None
+            now = time.time()
+            self._reclaim(now)
+            if self._free:
+                kid, _ = self._free.popitem(last=False)
+            else:
+                while True:
+                    until, kid = self._expiry.popleft()
+                    lease = self._leased.get(kid)
+                    if lease is not None and lease[1] == until:
+                        break
+            until = now + self.lease_seconds
+            self._leased[kid] = (holder, until)
+            self._expiry.append((until, kid))
+            return self._keys[kid], until
+
+    def release(self, api_key, holder=None):
+        """Return a leased key to the pool. False if it was not leased (by holder)."""
+        with self._lock:
+            kid = self._ids.get(api_key)
+            lease = self._leased.get(kid)
+            if lease is None or (holder and lease[0] and lease[0] != holder):
+                return False
+            del self._leased[kid]
+            self._free[kid] = None
+            return True
+
+    def discard(self, api_key):
+        with self._lock:
+            kid = self._ids.pop(api_key, None)
+            if kid is None:
+                return
+            self._keys.pop(kid, None)
+            self._free.pop(kid, None)
+            self._leased.pop(kid, None)
+
+    def stats(self):
+        with self._lock:
+            return {"total": len(self._keys), "free": len(self._free), "leased": len(self._leased)}
@@ -0,0 +1,85 @@
+import threading, time
+from collections import OrderedDict
+
+
+class LicenseCache:
+    """Bounded LRU of license status for the `check` hot path.
+
+    Entries are (id, active, mac_id, credit) tuples keyed by license key;
+    unknown keys are cached as None for `negative_ttl` seconds so that
+    floods of invalid keys stay off the database. `credit` is a snapshot:
+    ledger writes in this worker refresh it, writes in other workers are
+    picked up when the entry expires after `ttl` seconds.
+
+    Cross-worker invalidation is a version counter (the "licenses"
+    CacheVersion row): when `sync` sees a new version the whole cache is
+    dropped. Admin writes are rare, so a coarse flush is cheaper than
+    tracking individual keys.
+    """
+
+    def __init__(self, size=50000, ttl=60.0, negative_ttl=30.0):
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.version = None
+        self.checked_at = 0.0
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # key -> (expires_at, status or None)
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return (found, status). status is None for a cached unknown key."""
+        now = time.monotonic()
+        with self._lock:
+            ent = self._entries.get(key)
+            if ent is None or ent[0] <= now:
+                self.misses += 1
+                return False, None
+            self._entries.move_to_end(key)
+            if ent[1] is None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return True, ent[1]
+
+    def put(self, key, status):
+        ttl = self.ttl if status is not None else self.negative_ttl
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, status)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def update_credit(self, key, credit):
+        with self._lock:
+            ent = self._entries.get(key)
+            if ent is not None and ent[1] is not None:
+                self._entries[key] = (ent[0], ent[1][:3] + (credit,))
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def sync(self, version):
+        """Drop everything if the shared version moved since the last check."""
+        with self._lock:
+            if version != self.version:
+                self._entries.clear()
+                self.version = version
+            self.checked_at = time.monotonic()
+
+    def stats(self):
+        lookups = self.hits + self.negative_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "negative_hits": self.negative_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": round((self.hits + self.negative_hits) / lookups, 4) if lookups else 0.0,
+        }
@@ -0,0 +1,304 @@
+"""Background ActivityLog writer.
+
+Handlers submit compact (license_id, action, char_count, key, created_at)
+tuples; a worker thread turns them into multi-row INSERTs every `flush_ms`
+or `batch` records, whichever comes first.
+
+Durability comes from an append-only spool: every record is appended to the
+current segment file before it is queued. The worker rotates the segment,
+drains the queue (everything in the closed segment), inserts it and only
+then deletes the segment. A segment left behind by a failed flush or a
+crashed process is replayed from disk, one segment per transaction.
+
+Only errors caused by the records themselves (IntegrityError, DataError,
+malformed records) mark a segment as poisoned, e.g. a license deleted
+before its logs were written. After `max_failures` such attempts it is
+bisected: every record that can be inserted is, and the rest go to a
+`<segment>.failed` dead-letter file so the pipeline keeps moving. Anything
+else (OperationalError: database locked or unreachable) is transient and
+the segment is simply retried next round. `flask replay-failed-logs`
+retries the dead-letter files once the cause is fixed.
+"""
+import glob, json, os, threading, time
+from collections import deque
+from datetime import datetime
+from sqlalchemy import insert
+from sqlalchemy.exc import DataError, IntegrityError
+from models import db, ActivityLog
+from rollups import apply_rollups
+
+# Failures caused by the records themselves; anything else is retried as is.
+POISON_ERRORS = (IntegrityError, DataError, ValueError, TypeError)
+
+DETAILS = {
+    "debit": "Debited {n} credits for key {key}",
+    "refund": "Refunded {n} credits for key {key}",
+    "adjust_credit": "Adjusted credit by {n} for key {key}",
+    "create": "Created with {n} credits for key {key}",
+    "toggle": "Set active to {n} for key {key}",
+    "reset_mac": "Reset MAC for key {key}",
+}
+
+
+def format_details(action, n, key):
+    tpl = DETAILS.get(action)
+    return tpl.format(n=n, key=key) if tpl else f"{action} {n} for key {key}"
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _write_records(path, records, mode):
+    tmp = path + ".tmp" if mode == "w" else path
+    with open(tmp, mode, encoding="utf-8") as f:
+        for rec in records:
+            f.write(json.dumps(rec, separators=(",", ":")) + "\n")
+    if tmp != path:
+        os.replace(tmp, path)
+
+
+class ActivityLogWriter:
+    def __init__(self, app, spool_dir, flush_ms=200, batch=500, max_queue=10000, max_failures=3):
+        self.app = app
+        self.spool_dir = spool_dir
+        self.flush_ms = flush_ms
+        self.batch = batch
+        self.max_queue = max_queue
+        self.max_failures = max_failures
+        self._failures = {}  # segment path -> failed attempts while the DB was up
+        self._cond = threading.Condition()
+        self._queue = deque()
+        self._pid = None
+        self._thread = None
+        self._stop = False
+        self._seq = 0
+        self._segment = None
+        self._segment_path = None
+        self.flushed_total = 0
+        self.flush_errors = 0
+        self.blocked_total = 0
+        self.dead_lettered = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+
+    # ---------- producer side ----------
+    def submit(self, records):
+        """Spool and enqueue records; blocks while the queue is full."""
+        self._ensure_started()
+        with self._cond:
+            if len(self._queue) >= self.max_queue:
+                self.blocked_total += 1
+                self._cond.notify_all()
+                while len(self._queue) >= self.max_queue and not self._stop:
+                    self._cond.wait(0.05)
+            for rec in records:
+                self._segment.write(json.dumps(rec, separators=(",", ":")) + "\n")
+            self._segment.flush()
+            self._queue.extend(records)
+            if len(self._queue) >= self.batch:
+                self._cond.notify_all()
+
+    def metrics(self):
+        return {
+            "queue_depth": len(self._queue),
+            "flushed_total": self.flushed_total,
+            "flush_errors": self.flush_errors,
+            "blocked_total": self.blocked_total,
+            "dead_lettered": self.dead_lettered,
+            "last_flush_ms": round(self.last_flush_ms, 3),
+            "max_flush_ms": round(self.max_flush_ms, 3),
+            "pending_segments": len([p for p in self._segments(os.getpid()) if p != self._segment_path]),
+        }
+
+    # ---------- lifecycle ----------
+    def _ensure_started(self):
+        # Started lazily so every forked gunicorn worker gets its own thread.
+        if self._pid == os.getpid():
+            return
+        with self._cond:
+            if self._pid == os.getpid():
+                return
+            os.makedirs(self.spool_dir, exist_ok=True)
+            self._pid = os.getpid()
+            self._queue.clear()
+            self._stop = False
+            self._open_segment()
+            self._thread = threading.Thread(target=self._run, name="activity-log-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout=5.0):
+        if self._thread is None or self._pid != os.getpid():
+            return
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+
+    # ---------- spool segments ----------
+    def _open_segment(self):
+        self._seq += 1
+        self._segment_path = os.path.join(self.spool_dir, f"{self._pid}-{self._seq:08d}.ndjson")
+        self._segment = open(self._segment_path, "a", encoding="utf-8")
+
+    def _segments(self, pid):
+        return sorted(glob.glob(os.path.join(self.spool_dir, f"{pid}-*.ndjson")))
+
+    def _claim_orphans(self):
+        # Segments of dead processes are renamed into our namespace; the
+        # rename is atomic, so only one worker ever replays a given file.
+        for path in glob.glob(os.path.join(self.spool_dir, "*.ndjson")):
+            owner = os.path.basename(path).split("-", 1)[0]
+            if not owner.isdigit() or int(owner) == self._pid or _pid_alive(int(owner)):
+                continue
+            self._seq += 1
+            try:
+                os.rename(path, os.path.join(self.spool_dir, f"{self._pid}-{self._seq:08d}.ndjson"))
+            except OSError:
+                pass
+
+    @staticmethod
+    def _read_segment(path):
+        out = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    out.append(json.loads(line))
+                except ValueError:
+                    continue  # torn write at crash time
+        return out
+
+    # ---------- worker ----------
+    def _run(self):
+        self._claim_orphans()
+        while True:
+            with self._cond:
+                if not self._stop and len(self._queue) < self.batch:
+                    self._cond.wait(self.flush_ms / 1000.0)
+                stopping = self._stop
+                drained = list(self._queue)
+                self._queue.clear()
+                if drained:
+                    self._segment.close()
+                    self._open_segment()
+                self._cond.notify_all()
+            self._flush_closed(drained)
+            if stopping:
+                with self._cond:
+                    self._segment.close()
+                    if os.path.getsize(self._segment_path) == 0:
+                        os.remove(self._segment_path)
+                return
+
+    def _flush_closed(self, drained):
+        # When only the segment just closed is pending, `drained` is exactly
+        # its content and is used directly instead of re-reading the file.
+        # A backlog (failed flushes, orphans) is replayed segment by segment,
+        # so memory per transaction stays bounded by one segment.
+        closed = [p for p in self._segments(self._pid) if p != self._segment_path]
+        for p in closed:
+            records = drained if drained and len(closed) == 1 else self._read_segment(p)
+            if not self._flush_segment(p, records):
+                return  # database unreachable: retry everything next round
+
+    def _insert(self, records):
+        with self.app.app_context():
+            try:
+                if records:
+                    rows = [self._row(r) for r in records]
+                    db.session.execute(insert(ActivityLog), rows)
+                    apply_rollups(rows)
+                db.session.commit()
+            except Exception:
+                db.session.rollback()
+                raise
+
+    def _flush_segment(self, path, records):
+        """Insert one closed segment. Returns False on a transient error."""
+        t0 = time.perf_counter()
+        try:
+            self._insert(records)
+        except POISON_ERRORS:
+            self.flush_errors += 1
+            self._failures[path] = self._failures.get(path, 0) + 1
+            if self._failures[path] >= self.max_failures:
+                return self._dead_letter(path, records)
+            return True
+        except Exception:
+            self.flush_errors += 1
+            return False  # locked or unreachable: retry everything next round
+        os.remove(path)
+        self._failures.pop(path, None)
+        self.flushed_total += len(records)
+        self.last_flush_ms = (time.perf_counter() - t0) * 1000
+        self.max_flush_ms = max(self.max_flush_ms, self.last_flush_ms)
+        return True
+
+    def _dead_letter(self, path, records):
+        bad, left = self._settle(records)
+        if bad:
+            _write_records(path[:-len(".ndjson")] + ".failed", bad, "a")
+            self.dead_lettered += len(bad)
+        if left:
+            # Interrupted by a transient error: keep only what is still unsettled.
+            _write_records(path, left, "w")
+            return False
+        os.remove(path)
+        self._failures.pop(path, None)
+        return True
+
+    def _settle(self, records):
+        """Bisect records: insert what can be inserted on its own.
+
+        Returns (poison records, records left unsettled by a transient error).
+        """
+        bad, todo = [], [list(records)]
+        while todo:
+            chunk = todo.pop()
+            try:
+                self._insert(chunk)
+            except POISON_ERRORS:
+                if len(chunk) == 1:
+                    bad.append(chunk[0])
+                else:
+                    mid = len(chunk) // 2
+                    todo += [chunk[mid:], chunk[:mid]]
+                continue
+            except Exception:
+                todo.append(chunk)
+                return bad, [rec for part in reversed(todo) for rec in part]
+            self.flushed_total += len(chunk)
+        return bad, []
+
+    def replay_failed(self):
+        """Retry every dead-letter file. Returns (records inserted, records still failing)."""
+        inserted = failing = 0
+        for path in sorted(glob.glob(os.path.join(self.spool_dir, "*.failed"))):
+            records = self._read_segment(path)
+            bad, left = self._settle(records)
+            inserted += len(records) - len(bad) - len(left)
+            failing += len(bad) + len(left)
+            if bad or left:
+                _write_records(path, bad + left, "w")
+            else:
+                os.remove(path)
+            if left:
+                break  # transient error: the rest can wait for the next run
+        return inserted, failing
+
+    @staticmethod
+    def _row(rec):
+        license_id, action, n, key, created_at = rec
+        return {
+            "license_id": license_id,
+            "action": action,
+            "char_count": n,
+            "details": format_details(action, n, key),
+            "created_at": datetime.fromisoformat(created_at),
+        }
@@ -0,0 +1,213 @@
+"""Per-worker request metrics in the Prometheus text format, plus an opt-in
+sampling profiler for the slowest requests.
+
+Every process keeps its own numbers; under gunicorn each scrape of /metrics
+is answered by one worker, so scrape the workers individually or aggregate
+the series with sum() and a per-instance label.
+"""
+import heapq, itertools, os, sys, threading, time
+from collections import Counter as _Counter
+from sqlalchemy.pool import QueuePool
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 50, 100)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = (f'{n}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+             for n, v in zip(names, values))
+    return "{" + ",".join(pairs) + "}"
+
+
+def _num(v):
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, values=(), n=1):
+        with self._lock:
+            self._values[values] = self._values.get(values, 0) + n
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for values, v in sorted(self._values.items()):
+            yield f"{self.name}{_labels(self.labels, values)} {_num(v)}"
+
+
+class Histogram:
+    def __init__(self, name, help, buckets, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # label values -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, values, amount):
+        with self._lock:
+            row = self._values.get(values)
+            if row is None:
+                row = self._values[values] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if amount <= bound:
+                    row[i] += 1
+                    break
+            row[-2] += amount
+            row[-1] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        names = self.labels + ("le",)
+        for values, row in sorted(self._values.items()):
+            acc = 0
+            for bound, n in zip(self.buckets, row):
+                acc += n
+                yield f"{self.name}_bucket{_labels(names, values + (_num(bound),))} {acc}"
+            yield f"{self.name}_bucket{_labels(names, values + ('+Inf',))} {row[-1]}"
+            yield f"{self.name}_sum{_labels(self.labels, values)} {_num(row[-2])}"
+            yield f"{self.name}_count{_labels(self.labels, values)} {row[-1]}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def counter(self, *args, **kw):
+        m = Counter(*args, **kw)
+        self.metrics.append(m)
+        return m
+
+    def histogram(self, *args, **kw):
+        m = Histogram(*args, **kw)
+        self.metrics.append(m)
+        return m
+
+    def collector(self, fn):
+        """Register fn() -> iterable of (name, type, help, [(labels dict, value)]) read at scrape time."""
+        self.collectors.append(fn)
+        return fn
+
+    def render(self):
+        lines = []
+        for m in self.metrics:
+            lines.extend(m.render())
+        for fn in self.collectors:
+            for name, kind, help, samples in fn():
+                lines.append(f"# HELP {name} {help}")
+                lines.append(f"# TYPE {name} {kind}")
+                for labels, value in samples:
+                    lines.append(f"{name}{_labels(tuple(labels), tuple(labels.values()))} {_num(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+REQUEST_SECONDS = REGISTRY.histogram(
+    "amulet_request_seconds", "Request latency.", LATENCY_BUCKETS, ("endpoint", "action", "status"))
+SQL_QUERIES = REGISTRY.histogram(
+    "amulet_request_sql_queries", "SQL statements executed per request.", QUERY_BUCKETS, ("endpoint", "action"))
+SQL_SECONDS = REGISTRY.histogram(
+    "amulet_request_sql_seconds", "Time spent executing SQL per request.", LATENCY_BUCKETS, ("endpoint", "action"))
+COMMIT_SECONDS = REGISTRY.histogram(
+    "amulet_db_commit_seconds", "Time spent in transaction COMMIT.", LATENCY_BUCKETS)
+POOL_WAIT_SECONDS = REGISTRY.histogram(
+    "amulet_db_pool_wait_seconds", "Time spent waiting for a pooled connection.", LATENCY_BUCKETS)
+RATE_LIMITED = REGISTRY.counter(
+    "amulet_rate_limited_total", "Public API requests rejected with 429.", ("action", "dimension"))
+IDEMPOTENT_REPLAYS = REGISTRY.counter(
+    "amulet_idempotent_replays_total", "Ledger retries answered from the idempotency store.", ("source",))
+ERRORS = REGISTRY.counter(
+    "amulet_errors_total", "Responses with status >= 500 and unhandled exceptions.", ("endpoint", "kind"))
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that records how long each checkout waited for a connection."""
+
+    def _do_get(self):
+        t0 = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_WAIT_SECONDS.observe((), time.perf_counter() - t0)
+
+
+# ---------- sampling profiler ----------
+def _collapse(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+class SlowRequestProfiler:
+    """Samples the stacks of in-flight requests and keeps the slowest `keep`.
+
+    A daemon thread wakes every `interval_ms` and records the current stack
+    of every thread that is inside a request. When a request finishes, its
+    samples are kept only if it ranks among the slowest seen so far. The
+    result is rendered as collapsed stacks (flamegraph.pl / speedscope).
+    """
+
+    def __init__(self, keep=20, interval_ms=5):
+        self.keep = keep
+        self.interval = interval_ms / 1000.0
+        self._active = {}    # thread id -> [collapsed stack, ...]
+        self._slowest = []   # min-heap of (seconds, seq, label, Counter)
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._active.clear()
+                threading.Thread(target=self._run, name="request-profiler", daemon=True).start()
+
+    def begin(self):
+        self._ensure_started()
+        self._active[threading.get_ident()] = []
+
+    def end(self, label, seconds):
+        samples = self._active.pop(threading.get_ident(), None)
+        if not samples:
+            return
+        with self._lock:
+            if len(self._slowest) < self.keep:
+                heapq.heappush(self._slowest, (seconds, next(self._seq), label, _Counter(samples)))
+            elif seconds > self._slowest[0][0]:
+                heapq.heapreplace(self._slowest, (seconds, next(self._seq), label, _Counter(samples)))
+
+    def _run(self):
+        me = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            for tid, buf in list(self._active.items()):
+                frame = frames.get(tid)
+                if frame is not None and tid != me:
+                    buf.append(_collapse(frame))
+
+    def collapsed(self):
+        with self._lock:
+            kept = sorted(self._slowest, reverse=True)
+        lines = []
+        for seconds, _, label, stacks in kept:
+            root = f"{label} {seconds * 1000:.1f}ms".replace(";", ",").replace(" ", "_")
+            lines.extend(f"{root};{stack} {n}" for stack, n in stacks.most_common())
+        return "\n".join(lines) + ("\n" if lines else "")
+
+    def reset(self):
+        with self._lock:
+            self._slowest = []
@@ -0,0 +1,106 @@
+"""Idempotent schema migrations for databases created before a model change.
+
+`db.create_all()` only creates missing tables, so indexes and extensions
+added to existing tables are applied here. Every statement is safe to re-run.
+
+On PostgreSQL, index statements run as CREATE/DROP INDEX CONCURRENTLY in
+autocommit mode, so a build on a large table (e.g. from the first request of
+a worker with DB_AUTO_INIT=1) does not block writes. A concurrent build that
+fails leaves an INVALID index behind, which IF NOT EXISTS then skips; drop
+it by hand and re-run `flask --app app init-db`.
+"""
+import logging
+from sqlalchemy import text
+from models import ActivityLog
+
+log = logging.getLogger(__name__)
+
+
+def _sqlite_activity_log_autoincrement(conn):
+    """Rebuild a pre-AUTOINCREMENT activity_log so ids are never reused.
+
+    Without AUTOINCREMENT, SQLite restarts ids at MAX(id) + 1, so once
+    archive-logs empties the hot table new logs reuse ids already present in
+    activity_log_archive. The sequence is started past both tables, and live
+    rows that already reuse an archived id get a fresh one.
+    """
+    def plain():
+        sql = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'activity_log'")).scalar()
+        return sql is not None and "AUTOINCREMENT" not in sql.upper()
+    if not plain():
+        return
+    conn.exec_driver_sql("BEGIN IMMEDIATE")  # one atomic rebuild; other workers wait
+    if not plain():
+        return
+    cols = "id, license_id, action, char_count, details, created_at"
+    conn.execute(text("ALTER TABLE activity_log RENAME TO _activity_log_old"))
+    for (name,) in conn.execute(text(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = '_activity_log_old' AND sql IS NOT NULL")).all():
+        conn.execute(text(f'DROP INDEX "{name}"'))
+    ActivityLog.__table__.create(conn)
+    archived = "SELECT id FROM activity_log_archive"
+    conn.execute(text(f"INSERT INTO activity_log ({cols}) SELECT {cols} FROM _activity_log_old WHERE id NOT IN ({archived})"))
+    top = conn.execute(text(
+        "SELECT MAX(m) FROM (SELECT MAX(id) AS m FROM _activity_log_old UNION ALL SELECT MAX(id) FROM activity_log_archive)")).scalar()
+    if top:
+        conn.execute(text("DELETE FROM sqlite_sequence WHERE name = 'activity_log'"))
+        conn.execute(text("INSERT INTO sqlite_sequence (name, seq) VALUES ('activity_log', :top)"), {"top": top})
+    conn.execute(text(
+        f"INSERT INTO activity_log ({cols[4:]}) SELECT {cols[4:]} FROM _activity_log_old WHERE id IN ({archived}) ORDER BY id"))
+    conn.execute(text("DROP TABLE _activity_log_old"))
+
+
+# (dialects or None for all, statement or callable(conn)). Dialect-specific
+# statements are best effort: e.g. pg_trgm needs a role allowed to create
+# extensions. Callables are table rebuilds and always raise on failure.
+MIGRATIONS = [
+    (("sqlite",), _sqlite_activity_log_autoincrement),
+    (None, "CREATE INDEX IF NOT EXISTS ix_license_mac_id ON license (mac_id)"),
+    (None, "CREATE INDEX IF NOT EXISTS ix_activity_log_license_id ON activity_log (license_id)"),
+    (None, "CREATE INDEX IF NOT EXISTS ix_activity_log_created_at_id ON activity_log (created_at, id)"),
+    (None, "DROP INDEX IF EXISTS ix_activity_log_created_at"),
+    (None, "CREATE INDEX IF NOT EXISTS ix_activity_log_action ON activity_log (action)"),
+    # Case-insensitive prefix search on key/mac_id (app._license_search).
+    (("sqlite", "postgresql"), "CREATE INDEX IF NOT EXISTS ix_license_key_lower ON license (lower(key))"),
+    (("sqlite", "postgresql"), "CREATE INDEX IF NOT EXISTS ix_license_mac_id_lower ON license (lower(mac_id))"),
+    # Trigram indexes let ILIKE '%q%' on key/mac_id use an index on PostgreSQL.
+    (("postgresql",), "CREATE EXTENSION IF NOT EXISTS pg_trgm"),
+    (("postgresql",), "CREATE INDEX IF NOT EXISTS ix_license_key_trgm ON license USING gin (key gin_trgm_ops)"),
+    (("postgresql",), "CREATE INDEX IF NOT EXISTS ix_license_mac_id_trgm ON license USING gin (mac_id gin_trgm_ops)"),
+]
+
+
+def _concurrently(stmt):
+    """The non-blocking PostgreSQL form of an index statement, or None."""
+    for verb in ("CREATE INDEX ", "DROP INDEX "):
+        if stmt.startswith(verb):
+            return verb + "CONCURRENTLY " + stmt[len(verb):]
+    return None
+
+
+def run_migrations(engine):
+    """Apply every migration for the engine's dialect. Returns the count applied."""
+    applied = 0
+    postgres = engine.dialect.name == "postgresql"
+    for dialects, stmt in MIGRATIONS:
+        if dialects and engine.dialect.name not in dialects:
+            continue
+        concurrent = _concurrently(stmt) if postgres and not callable(stmt) else None
+        try:
+            if callable(stmt):
+                with engine.begin() as conn:
+                    stmt(conn)
+            elif concurrent:
+                # CONCURRENTLY cannot run inside a transaction block.
+                with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                    conn.execute(text(concurrent))
+            else:
+                with engine.begin() as conn:
+                    conn.execute(text(stmt))
+        except Exception as e:
+            if not dialects or callable(stmt):
+                raise
+            log.warning("migration skipped (%s): %s", stmt, e)
+            continue
+        applied += 1
+    return applied
@@ -6,7 +6,7 @@ db = SQLAlchemy()
 class License(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     key = db.Column(db.String(255), unique=True, nullable=False)
-    mac_id = db.Column(db.String(255), nullable=True)
+    mac_id = db.Column(db.String(255), nullable=True, index=True)
     credit = db.Column(db.Integer, default=0)
     active = db.Column(db.Boolean, default=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -34,8 +34,59 @@ class Config(db.Model):
 
 class ActivityLog(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    license_id = db.Column(db.Integer, db.ForeignKey('license.id'), nullable=False)
+    license_id = db.Column(db.Integer, db.ForeignKey('license.id'), nullable=False, index=True)
+    action = db.Column(db.String(50), nullable=False, index=True)
+    char_count = db.Column(db.Integer, default=0)
+    details = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # AUTOINCREMENT so SQLite never reuses an id that archive-logs moved away.
+    __table_args__ = (db.Index('ix_activity_log_created_at_id', 'created_at', 'id'),
+                      {'sqlite_autoincrement': True})
+
+class ActivityLogArchive(db.Model):
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    license_id = db.Column(db.Integer, nullable=False, index=True)
     action = db.Column(db.String(50), nullable=False)
     char_count = db.Column(db.Integer, default=0)
     details = db.Column(db.Text, nullable=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
\ No newline at end of file
+    created_at = db.Column(db.DateTime, index=True)
+
+class CacheVersion(db.Model):
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, default=0, nullable=False)
+
+class UsageHourly(db.Model):
+    bucket = db.Column(db.DateTime, primary_key=True)
+    license_id = db.Column(db.Integer, primary_key=True)
+    action = db.Column(db.String(50), primary_key=True)
+    char_sum = db.Column(db.BigInteger, default=0, nullable=False)
+    events = db.Column(db.Integer, default=0, nullable=False)
+
+class UsageDaily(db.Model):
+    bucket = db.Column(db.DateTime, primary_key=True)
+    license_id = db.Column(db.Integer, primary_key=True)
+    action = db.Column(db.String(50), primary_key=True)
+    char_sum = db.Column(db.BigInteger, default=0, nullable=False)
+    events = db.Column(db.Integer, default=0, nullable=False)
+
+class ChangeEvent(db.Model):
+    # AUTOINCREMENT so SQLite never reuses a seq after old events are pruned.
+    __table_args__ = {'sqlite_autoincrement': True}
+
+    id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(20), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=True)
+    op = db.Column(db.String(20), nullable=False)
+    data = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+class IdempotencyKey(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    license_key = db.Column(db.String(255), nullable=False)
+    request_id = db.Column(db.String(128), nullable=False)
+    fingerprint = db.Column(db.String(16), nullable=False)
+    response = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    __table_args__ = (db.UniqueConstraint('license_key', 'request_id', name='uq_idempotency_key_request'),)
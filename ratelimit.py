@@ -0,0 +1,153 @@
+"""Token-bucket rate limiting for the public /api endpoint.
+
+Budgets are configured per (action, dimension), where the dimension is the
+license key, the MAC or the client IP, with a "*" action acting as the
+default:
+
+    RATE_LIMITS="check:key=2/20;debit:key=20/100;*:ip=50/200"
+
+means `check` may be called 2 times per second per license key with bursts
+of up to 20, and so on. A request passes only if every bucket that applies
+to it has a token; nothing is consumed when any of them is empty.
+
+Backends share one method, `take(buckets)`, where buckets is a list of
+(name, rate, burst). It returns one wait per bucket: 0.0 where a token was
+available, otherwise the seconds until one will be.
+"""
+import math, threading, time
+from collections import OrderedDict
+
+DEFAULT_LIMITS = "check:key=2/20;check:mac=2/20;debit:key=20/100;refund:key=20/100;" \
+                 "debit_batch:key=5/20;refund_batch:key=5/20"
+# Added to the defaults only when the client IP comes from a trusted proxy:
+# behind a proxy, remote_addr is the proxy itself and every client would
+# share one bucket.
+DEFAULT_IP_LIMITS = "*:ip=50/200"
+DIMENSIONS = ("key", "mac", "ip")
+
+
+def parse_limits(spec):
+    """"action:dim=rate/burst;..." -> {(action, dim): (rate, burst)}."""
+    limits = {}
+    for part in (spec or "").split(";"):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            target, budget = part.split("=", 1)
+            action, dim = target.split(":", 1)
+            rate, burst = budget.split("/", 1)
+            rate, burst = float(rate), float(burst)
+        except ValueError:
+            raise ValueError(f"bad rate limit {part!r}, expected action:dim=rate/burst")
+        if dim not in DIMENSIONS:
+            raise ValueError(f"bad rate limit dimension {dim!r} (one of {', '.join(DIMENSIONS)})")
+        if rate <= 0 or burst < 1:
+            raise ValueError(f"bad rate limit {part!r}: rate must be > 0 and burst >= 1")
+        limits[(action.strip(), dim)] = (rate, burst)
+    return limits
+
+
+class MemoryBackend:
+    """Per-process buckets in a bounded LRU; every take() is O(buckets)."""
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()  # name -> (tokens, updated_at)
+
+    def take(self, buckets):
+        now = time.monotonic()
+        with self._lock:
+            levels, waits = [], []
+            for name, rate, burst in buckets:
+                tokens, ts = self._buckets.get(name, (burst, now))
+                tokens = min(burst, tokens + (now - ts) * rate)
+                levels.append(tokens)
+                waits.append((1 - tokens) / rate if tokens < 1 else 0.0)
+            allowed = not any(waits)
+            for (name, rate, burst), tokens in zip(buckets, levels):
+                self._buckets[name] = (tokens - 1 if allowed else tokens, now)
+                self._buckets.move_to_end(name)
+            while len(self._buckets) > self.max_entries:
+                self._buckets.popitem(last=False)
+            return waits
+
+
+class RedisBackend:
+    """Buckets shared by every worker through Redis (needs the `redis` package).
+
+    One Lua script checks and updates all buckets of a request atomically,
+    using the Redis clock so workers on different hosts agree on time.
+    """
+
+    SCRIPT = """
+    local now = redis.call('TIME')
+    now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+    local levels, waits, allowed = {}, {}, true
+    for i, key in ipairs(KEYS) do
+        local rate, burst = tonumber(ARGV[2 * i - 1]), tonumber(ARGV[2 * i])
+        local b = redis.call('HMGET', key, 't', 'ts')
+        local t = tonumber(b[1]) or burst
+        local ts = tonumber(b[2]) or now
+        t = math.min(burst, t + math.max(0, now - ts) * rate)
+        levels[i] = t
+        waits[i] = '0'
+        if t < 1 then
+            waits[i] = tostring((1 - t) / rate)
+            allowed = false
+        end
+    end
+    for i, key in ipairs(KEYS) do
+        local rate, burst = tonumber(ARGV[2 * i - 1]), tonumber(ARGV[2 * i])
+        local t = levels[i]
+        if allowed then t = t - 1 end
+        redis.call('HSET', key, 't', tostring(t), 'ts', tostring(now))
+        redis.call('PEXPIRE', key, math.ceil(burst / rate * 1000) + 1000)
+    end
+    return waits
+    """
+
+    def __init__(self, url, prefix="amulet:rl:"):
+        import redis  # optional dependency, only needed for this backend
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url, socket_timeout=0.05, socket_connect_timeout=0.2)
+        self._script = self._client.register_script(self.SCRIPT)
+
+    def take(self, buckets):
+        args = []
+        for _, rate, burst in buckets:
+            args += [rate, burst]
+        return [float(w) for w in self._script(keys=[self.prefix + name for name, _, _ in buckets], args=args)]
+
+
+class RateLimiter:
+    def __init__(self, limits, backend):
+        self.limits = limits
+        self.backend = backend
+        self.errors = 0
+
+    def check(self, action, values):
+        """values: {dimension: value}. Returns (retry_after seconds, limited dimensions)."""
+        buckets, dims = [], []
+        for dim, value in values.items():
+            if not value:
+                continue
+            budget = self.limits.get((action, dim)) or self.limits.get(("*", dim))
+            if budget:
+                buckets.append((f"{action}:{dim}:{value}", budget[0], budget[1]))
+                dims.append(dim)
+        if not buckets:
+            return 0.0, ()
+        try:
+            waits = self.backend.take(buckets)
+        except Exception:
+            # A shared backend outage must not take the API down with it.
+            self.errors += 1
+            return 0.0, ()
+        limited = tuple(d for d, w in zip(dims, waits) if w)
+        return (max(waits), limited) if limited else (0.0, ())
+
+    @staticmethod
+    def retry_after_header(wait):
+        return str(max(1, math.ceil(wait)))
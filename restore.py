@@ -0,0 +1,339 @@
+"""Restore a backup produced by /admin_api/backup.
+
+Accepts the JSON document or NDJSON formats (optionally gzipped) and streams
+them: rows are read incrementally and upserted in chunks with
+INSERT ... ON CONFLICT, so memory stays bounded by the chunk size.
+"""
+import gzip, io, itertools, json, zlib
+from datetime import datetime
+from sqlalchemy import insert, select, text, update
+from models import db, License, ApiKey, Voice, Config, ActivityLog, ActivityLogArchive
+from dbdialect import dialect_insert
+from rollups import apply_rollups
+
+RESTORE_CHUNK = 5000
+READ_SIZE = 256 * 1024
+
+# table -> (model, natural key, columns updated when the row already exists)
+RESTORE_TABLES = {
+    "licenses": (License, "key", ("mac_id", "credit", "active", "created_at", "updated_at")),
+    "apikeys": (ApiKey, "api_key", ("status",)),
+    "voices": (Voice, "voice_id", ("name", "active")),
+    "activity_logs": (ActivityLog, "id", ()),
+}
+# Tables keyed by id: a row only counts as already present when these
+# columns match too. Otherwise the id belongs to a different local row and
+# the backup row is inserted under a fresh id.
+CONTENT_COLS = {"activity_logs": ("license_id", "action", "char_count", "details", "created_at")}
+DATETIME_COLS = {"created_at", "updated_at"}
+NULLABLE_COLS = {"mac_id"}
+
+
+class RestoreError(ValueError):
+    pass
+
+
+# ---------- reading ----------
+def _open(fileobj):
+    raw = fileobj if hasattr(fileobj, "peek") else io.BufferedReader(fileobj)
+    if raw.peek(2)[:2] == b"\x1f\x8b":
+        raw = io.BufferedReader(gzip.GzipFile(fileobj=raw))
+    return io.TextIOWrapper(raw, encoding="utf-8")
+
+
+def iter_backup_records(fileobj):
+    """Yield (table, row) pairs from a JSON or NDJSON backup stream."""
+    try:
+        yield from _iter_records(_open(fileobj))
+    except (OSError, EOFError, zlib.error) as e:  # corrupt or truncated gzip
+        raise RestoreError(f"unreadable backup: {e}")
+
+
+def _iter_records(stream):
+    first = stream.readline()
+    try:
+        head = json.loads(first)
+    except ValueError:
+        head = None
+    if isinstance(head, dict) and "table" in head:
+        for line in itertools.chain([first], stream):
+            line = line.strip()
+            if not line:
+                continue
+            rec = json.loads(line)
+            yield rec["table"], rec["row"]
+        return
+    yield from _iter_json_document(first, stream)
+
+
+def _iter_json_document(first, stream):
+    """Incremental reader for {"table": [row, ...], "config": {...}}.
+
+    Each row is decoded with raw_decode as soon as it is complete, so the
+    whole document never has to be in memory at once.
+    """
+    dec = json.JSONDecoder()
+    buf, pos, eof = first, 0, False
+
+    def fill():
+        nonlocal buf, pos, eof
+        chunk = stream.read(READ_SIZE)
+        if not chunk:
+            eof = True
+        buf = buf[pos:] + chunk
+        pos = 0
+
+    def skip_ws():
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buf) or eof:
+                return
+            fill()
+
+    def expect(chars):
+        nonlocal pos
+        skip_ws()
+        if pos >= len(buf) or buf[pos] not in chars:
+            raise RestoreError(f"malformed backup: expected {chars!r}")
+        pos += 1
+        return buf[pos - 1]
+
+    def value():
+        nonlocal pos
+        while True:
+            skip_ws()
+            try:
+                obj, end = dec.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise RestoreError("malformed backup: truncated value")
+                fill()
+                continue
+            # A number at the buffer edge may decode early; make sure it ended.
+            if end == len(buf) and not eof:
+                fill()
+                continue
+            pos = end
+            return obj
+
+    expect("{")
+    skip_ws()
+    if buf[pos:pos + 1] == "}":
+        return
+    while True:
+        name = value()
+        expect(":")
+        skip_ws()
+        if buf[pos:pos + 1] == "[":
+            pos += 1
+            skip_ws()
+            if buf[pos:pos + 1] == "]":
+                pos += 1
+            else:
+                while True:
+                    yield name, value()
+                    if expect(",]") == "]":
+                        break
+        else:
+            yield name, value()
+        if expect(",}") == "}":
+            return
+
+
+# ---------- writing ----------
+def _coerce(table, row):
+    model, natural, _ = RESTORE_TABLES[table]
+    out = {}
+    for col, val in row.items():
+        if not hasattr(model, col):
+            continue
+        if col in DATETIME_COLS:
+            val = datetime.fromisoformat(val) if val else None
+        elif col in NULLABLE_COLS:
+            val = val or None
+        out[col] = val
+    if not out.get(natural):
+        raise RestoreError(f"{table}: row without {natural}")
+    return out
+
+
+def _upsert(model, natural, update_cols, rows, existing=False):
+    if not rows:
+        return
+    stmt = dialect_insert(model)
+    if stmt is None:
+        # No ON CONFLICT support: rows were already split by the prefetch.
+        db.session.execute(update(model) if existing else insert(model), rows)
+        return
+    if update_cols:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[natural],
+            set_={c: getattr(stmt.excluded, c) for c in update_cols})
+    else:
+        stmt = stmt.on_conflict_do_nothing(index_elements=[natural])
+    db.session.execute(stmt, rows)
+
+
+def _same(a, b):
+    # Backups write NULL as "", so the two compare equal.
+    return (None if a == "" else a) == (None if b == "" else b)
+
+
+def _sync_sequence(model):
+    """Move a PostgreSQL id sequence past rows inserted with explicit ids."""
+    if db.engine.dialect.name != "postgresql":
+        return
+    t = model.__tablename__
+    db.session.execute(text(
+        f"SELECT setval(pg_get_serial_sequence('{t}', 'id'), COALESCE((SELECT MAX(id) FROM {t}), 1))"))
+
+
+class _Restorer:
+    def __init__(self, dry_run):
+        self.dry_run = dry_run
+        self.stats = {}
+        self.license_ids = {}  # backup license id -> local id, only where they differ
+
+    def _count(self, table, what, n=1):
+        if n:
+            t = self.stats.setdefault(table, {"insert": 0, "update": 0, "unchanged": 0})
+            t[what] += n
+
+    def flush(self, table, rows):
+        model, natural, update_cols = RESTORE_TABLES[table]
+        rows = list({r[natural]: r for r in rows}.values())  # last occurrence wins
+        if table == "activity_logs":
+            for r in rows:
+                r["license_id"] = self.license_ids.get(r.get("license_id"), r.get("license_id"))
+        keys = [r[natural] for r in rows]
+        content_cols = CONTENT_COLS.get(table, ())
+        cols = [model.id, getattr(model, natural)] + [getattr(model, c) for c in update_cols + content_cols]
+        existing = {found[1]: found for found in
+                    db.session.execute(select(*cols).where(getattr(model, natural).in_(keys)))}
+        if table == "activity_logs":
+            # Logs moved out by archive-logs are present too, just elsewhere.
+            missing = [k for k in keys if k not in existing]
+            if missing:
+                arch = [ActivityLogArchive.id, ActivityLogArchive.id] + \
+                       [getattr(ActivityLogArchive, c) for c in content_cols]
+                existing.update((found[1], found) for found in
+                                db.session.execute(select(*arch).where(ActivityLogArchive.id.in_(missing))))
+        taken = set()
+        if natural != "id":
+            ids = [r["id"] for r in rows if r.get("id") is not None and r[natural] not in existing]
+            if ids:
+                taken = set(db.session.execute(select(model.id).where(model.id.in_(ids))).scalars())
+
+        updates, inserts, relocated, changed, unchanged = [], [], [], 0, 0
+        for r in rows:
+            old = existing.get(r[natural])
+            if old is not None and content_cols and not all(
+                    _same(r.get(c), v) for c, v in zip(content_cols, old[2 + len(update_cols):])):
+                relocated.append((r.pop("id"), r))
+            elif old is not None:
+                backup_id = r.get("id")
+                if table == "licenses" and backup_id is not None and backup_id != old[0]:
+                    self.license_ids[backup_id] = old[0]
+                r["id"] = old[0]
+                if any(r[c] != v for c, v in zip(update_cols, old[2:]) if c in r):
+                    changed += 1
+                    updates.append(r)
+                else:
+                    unchanged += 1
+            elif natural != "id" and r.get("id") in taken:
+                relocated.append((r.pop("id"), r))
+            else:
+                inserts.append(r)
+        if relocated and table == "activity_logs":
+            # A log relocated by an earlier restore of this backup is already here.
+            copies = self._existing_copies(model, content_cols, [r for _, r in relocated])
+            kept = [(i, r) for i, r in relocated if tuple(r.get(c) for c in content_cols) not in copies]
+            unchanged += len(relocated) - len(kept)
+            relocated = kept
+        self._count(table, "insert", len(inserts) + len(relocated))
+        self._count(table, "update", changed)
+        self._count(table, "unchanged", unchanged)
+        if self.dry_run:
+            return
+
+        _upsert(model, natural, update_cols, updates, existing=True)
+        _upsert(model, natural, update_cols, inserts)
+        if relocated:
+            # The backup id already belongs to a different row: take a fresh
+            # id, which the sequence must not hand out to the rows above.
+            _sync_sequence(model)
+            if table == "licenses":
+                for backup_id, r in relocated:
+                    res = db.session.execute(insert(model).values(**r))
+                    self.license_ids[backup_id] = res.inserted_primary_key[0]
+            else:
+                db.session.execute(insert(model), [r for _, r in relocated])
+        if table == "activity_logs":
+            # Only the new rows: existing rollups may also cover archived logs.
+            apply_rollups([r for r in inserts + [r for _, r in relocated] if r.get("created_at")])
+
+    @staticmethod
+    def _existing_copies(model, content_cols, rows):
+        """Content tuples of `rows` that some local row already has, under any id."""
+        lids = {r.get("license_id") for r in rows}
+        stamps = {r.get("created_at") for r in rows}
+        found = db.session.execute(select(*[getattr(model, c) for c in content_cols])
+                                   .where(model.license_id.in_(lids), model.created_at.in_(stamps)))
+        norm = lambda t: tuple(None if v == "" else v for v in t)
+        have = {norm(f) for f in found}
+        return {tuple(r.get(c) for c in content_cols) for r in rows
+                if norm(tuple(r.get(c) for c in content_cols)) in have}
+
+    def config(self, row):
+        c = Config.query.first()
+        fields = ("latest_version", "force_update", "maintenance", "maintenance_message",
+                  "update_description", "update_links")
+        row = {f: row[f] for f in fields if f in row}
+        if c is None:
+            self._count("config", "insert")
+            if not self.dry_run:
+                db.session.add(Config(**row))
+            return
+        changed = any(getattr(c, f) != v for f, v in row.items())
+        self._count("config", "update" if changed else "unchanged")
+        if changed and not self.dry_run:
+            db.session.execute(update(Config).where(Config.id == c.id).values(**row))
+
+    def fix_sequences(self):
+        for model, _, _ in RESTORE_TABLES.values():
+            _sync_sequence(model)
+
+
+def restore_backup(fileobj, dry_run=False, chunk=RESTORE_CHUNK):
+    """Upsert every record of a backup in one transaction.
+
+    Returns per-table {"insert", "update", "unchanged"} counts. With dry_run
+    the counts describe what would change and the transaction is rolled back.
+    """
+    r = _Restorer(dry_run)
+    pending, table = [], None
+    try:
+        for name, row in iter_backup_records(fileobj):
+            if name == "config":
+                r.config(row or {})
+                continue
+            if name not in RESTORE_TABLES:
+                raise RestoreError(f"unknown table in backup: {name}")
+            if name != table or len(pending) >= chunk:
+                if pending:
+                    r.flush(table, pending)
+                pending, table = [], name
+            pending.append(_coerce(name, row))
+        if pending:
+            r.flush(table, pending)
+        if dry_run:
+            db.session.rollback()
+        else:
+            r.fix_sequences()
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return r.stats
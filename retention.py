@@ -0,0 +1,49 @@
+"""Retention: move old ActivityLog rows to activity_log_archive in batches.
+
+Keeping the hot table small keeps debit inserts and recent-log queries fast
+as history grows. Each batch is one short transaction (copy, then delete by
+id), so live traffic is never blocked for long. Usage rollups are left
+untouched, so stats keep covering archived periods.
+
+delete_older_than() is the same batched delete for tables whose old rows
+are simply dropped (change feed events, idempotency results).
+"""
+from datetime import datetime, timedelta
+from sqlalchemy import delete, insert, select
+from models import db, ActivityLog, ActivityLogArchive
+
+ARCHIVE_BATCH = 10000
+DELETE_BATCH = 5000
+LOG_COLUMNS = ("id", "license_id", "action", "char_count", "details", "created_at")
+
+
+def archive_logs(older_than_days, batch=ARCHIVE_BATCH, keep_archive=True):
+    """Archive (or just delete) logs older than the cutoff. Returns rows moved."""
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    cols = [getattr(ActivityLog, c) for c in LOG_COLUMNS]
+    moved = 0
+    while True:
+        batch_ids = (select(ActivityLog.id).where(ActivityLog.created_at < cutoff)
+                     .order_by(ActivityLog.created_at, ActivityLog.id).limit(batch))
+        if keep_archive:
+            db.session.execute(insert(ActivityLogArchive).from_select(
+                list(LOG_COLUMNS), select(*cols).where(ActivityLog.id.in_(batch_ids))))
+        n = db.session.execute(delete(ActivityLog).where(ActivityLog.id.in_(batch_ids))).rowcount
+        db.session.commit()
+        moved += n
+        if n < batch:
+            return moved
+
+
+def delete_older_than(model, cutoff, batch=DELETE_BATCH, max_batches=None):
+    """Delete `model` rows created before `cutoff`, `batch` rows per transaction. Returns rows deleted."""
+    deleted = batches = 0
+    while max_batches is None or batches < max_batches:
+        ids = select(model.id).where(model.created_at < cutoff).order_by(model.id).limit(batch)
+        n = db.session.execute(delete(model).where(model.id.in_(ids))).rowcount
+        db.session.commit()
+        deleted += n
+        batches += 1
+        if n < batch:
+            break
+    return deleted
@@ -0,0 +1,91 @@
+"""Hourly/daily usage rollups over ActivityLog.
+
+Every code path that inserts ActivityLog rows calls `apply_rollups` in the
+same transaction, so UsageHourly/UsageDaily stay in step with the log.
+`rebuild_rollups` recomputes a time range from the log and its archive
+(backfill/repair).
+"""
+from collections import defaultdict
+from datetime import timedelta
+from sqlalchemy import delete, select, update
+from models import db, ActivityLog, ActivityLogArchive, UsageHourly, UsageDaily
+from dbdialect import dialect_insert
+
+REBUILD_BATCH = 5000
+
+
+def hour_bucket(ts):
+    return ts.replace(minute=0, second=0, microsecond=0)
+
+
+def day_bucket(ts):
+    return ts.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _aggregate(rows):
+    hourly, daily = defaultdict(lambda: [0, 0]), defaultdict(lambda: [0, 0])
+    for r in rows:
+        ts = r["created_at"]
+        for agg, bucket in ((hourly, hour_bucket(ts)), (daily, day_bucket(ts))):
+            acc = agg[(bucket, r["license_id"], r["action"])]
+            acc[0] += r.get("char_count") or 0
+            acc[1] += 1
+    return hourly, daily
+
+
+def _add(model, agg):
+    if not agg:
+        return
+    rows = [{"bucket": b, "license_id": lid, "action": a, "char_sum": s, "events": n}
+            for (b, lid, a), (s, n) in agg.items()]
+    stmt = dialect_insert(model)
+    if stmt is not None:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["bucket", "license_id", "action"],
+            set_={"char_sum": model.char_sum + stmt.excluded.char_sum,
+                  "events": model.events + stmt.excluded.events})
+        db.session.execute(stmt, rows)
+        return
+    for r in rows:
+        res = db.session.execute(
+            update(model)
+            .where(model.bucket == r["bucket"], model.license_id == r["license_id"], model.action == r["action"])
+            .values(char_sum=model.char_sum + r["char_sum"], events=model.events + r["events"]))
+        if not res.rowcount:
+            db.session.add(model(**r))
+
+
+def apply_rollups(rows):
+    """Fold ActivityLog row dicts (license_id, action, char_count, created_at) into the rollups."""
+    hourly, daily = _aggregate(rows)
+    _add(UsageHourly, hourly)
+    _add(UsageDaily, daily)
+
+
+def rebuild_rollups(since=None, until=None):
+    """Recompute rollups for whole days in [since, until) from ActivityLog
+    and ActivityLogArchive.
+
+    Both tables are streamed and aggregated in memory one batch at a time,
+    so memory is bounded by the batch, not the range. Logs removed with
+    `archive-logs --delete-only` exist nowhere else: rebuilding a range
+    that contained them drops them from the stats.
+    """
+    since = day_bucket(since) if since else None
+    until = day_bucket(until) + timedelta(days=1) if until else None
+    for model in (UsageHourly, UsageDaily):
+        stmt = delete(model)
+        if since: stmt = stmt.where(model.bucket >= since)
+        if until: stmt = stmt.where(model.bucket < until)
+        db.session.execute(stmt)
+    total = 0
+    for log in (ActivityLog, ActivityLogArchive):
+        q = select(log.license_id, log.action, log.char_count, log.created_at).where(log.created_at.isnot(None))
+        if since: q = q.where(log.created_at >= since)
+        if until: q = q.where(log.created_at < until)
+        result = db.session.execute(q.order_by(log.created_at).execution_options(yield_per=REBUILD_BATCH))
+        for part in result.partitions():
+            apply_rollups([r._asdict() for r in part])
+            total += len(part)
+    db.session.commit()
+    return total
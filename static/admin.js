@@ -6,6 +6,11 @@ async function jfetch(url, method="GET", data=null) {
   if (!r.ok) throw new Error(`${r.status} ${r.statusText}`);
   return await r.json();
 }
+async function jfetchPage(url) {
+  const r = await fetch(url, { headers: { "Content-Type":"application/json" } });
+  if (!r.ok) throw new Error(`${r.status} ${r.statusText}`);
+  return { rows: await r.json(), next: r.headers.get("X-Next-Cursor"), total: r.headers.get("X-Total-Count") };
+}
 function el(id){ return document.getElementById(id); }
 function toast(msg){ alert(msg); } // Changed to alert for better visibility
 
@@ -16,18 +21,70 @@ function copyToClipboard(text) {
   );
 }
 
+// ---- keyset paging state (infinite scroll) ----
+const PAGE_SIZE = 200;
+const pages = {
+  licenses: { next: null, loading: false },
+  apikeys:  { next: null, loading: false },
+  voices:   { next: null, loading: false },
+  logs:     { next: null, loading: false }
+};
+// Returns the page url, or null when there is nothing more to fetch.
+function pageUrl(pg, base, append){
+  if (append && (pg.loading || !pg.next)) return null;
+  const sep = base.includes("?") ? "&" : "?";
+  return `${base}${sep}limit=${PAGE_SIZE}` + (append ? `&before=${pg.next}` : "");
+}
+
+// ---- in-memory tables, patched in place by the change feed ----
+const tables = {
+  license: { rows: new Map(), tbody: "licTbody",    render: licenseRowHtml, load: ()=>loadLicenses(),
+             acceptsNew: ()=>!el("licSearch").value.trim() },
+  apikey:  { rows: new Map(), tbody: "keysTbody",   render: apiKeyRowHtml,  load: ()=>loadApiKeys(),
+             acceptsNew: ()=>true },
+  voice:   { rows: new Map(), tbody: "voicesTbody", render: voiceRowHtml,   load: ()=>loadVoices(),
+             acceptsNew: ()=>true }
+};
+function clearRows(entity){
+  tables[entity].rows.clear();
+  el(tables[entity].tbody).innerHTML = "";
+}
+function putRow(entity, row, prepend=false){
+  const t = tables[entity];
+  t.rows.set(row.id, row);
+  let tr = el(`${entity}-${row.id}`);
+  if (!tr){
+    tr = document.createElement("tr");
+    tr.id = `${entity}-${row.id}`;
+    if (prepend) el(t.tbody).prepend(tr); else el(t.tbody).appendChild(tr);
+  }
+  tr.innerHTML = t.render(row);
+  return tr;
+}
+
 // ================= Licenses =================
 let currentLicEditId = null;
 
-async function loadLicenses(){
+async function loadLicenses(append=false){
+  const pg = pages.licenses;
+  const q = encodeURIComponent(el("licSearch").value || "");
+  const url = pageUrl(pg, `/admin_api/licenses?q=${q}`, append);
+  if (!url) return;
+  pg.loading = true;
   try{
-    const q = encodeURIComponent(el("licSearch").value || "");
-    const data = await jfetch(`/admin_api/licenses?q=${q}`);
-    const tb = el("licTbody");
-    tb.innerHTML = "";
-    data.forEach(row=>{
-      const tr = document.createElement("tr");
-      tr.innerHTML = `
+    const page = await jfetchPage(url);
+    pg.next = page.next;
+    if (!append){
+      clearRows("license");
+      el("licTotal").textContent = page.total ? `Всього: ${page.total}` : "";
+    }
+    page.rows.forEach(row=>putRow("license", row));
+  }catch(e){ toast("Load licenses error: "+e.message); }
+  finally{ pg.loading = false; }
+}
+
+function licenseRowHtml(row){
+  return `
         <td>${row.id}</td>
         <td><code class="copyable" onclick="copyToClipboard('${row.key.replace(/'/g, "\\'")}')">${row.key}</code></td>
         <td>${row.mac_id || ""}</td>
@@ -40,9 +97,6 @@ async function loadLicenses(){
           <button class="btn btn-sm btn-outline-warning me-1" onclick="toggleLicense(${row.id})">🔁</button>
           <button class="btn btn-sm btn-outline-danger" onclick="deleteLicense(${row.id})">🗑</button>
         </td>`;
-      tb.appendChild(tr);
-    });
-  }catch(e){ toast("Load licenses error: "+e.message); }
 }
 
 function resetLicenseForm(){
@@ -80,7 +134,7 @@ async function submitLicense(){
       await jfetch(`/admin_api/licenses`, "POST", payload);
     }
     resetLicenseForm();
-    await loadLicenses();
+    await refresh(loadLicenses);
   }catch(e){ toast("Save license error: "+e.message); }
 }
 
@@ -88,14 +142,14 @@ async function deleteLicense(id){
   if (!confirm("Видалити ліцензію?")) return;
   try{
     await jfetch(`/admin_api/licenses/${id}`, "DELETE");
-    await loadLicenses();
+    await refresh(loadLicenses);
   }catch(e){ toast("Delete error: "+e.message); }
 }
 
 async function toggleLicense(id){
   try{
     await jfetch(`/admin_api/licenses/${id}/toggle`, "POST", {});
-    await loadLicenses();
+    await refresh(loadLicenses);
   }catch(e){ toast("Toggle error: "+e.message); }
 }
 
@@ -108,21 +162,63 @@ async function applyDelta(){
     toast("New credit: "+res.credit);
     el("licDelta").value = "";
     el("licCredit").value = res.credit;
-    await loadLicenses();
+    await refresh(loadLicenses);
   }catch(e){ toast("Δ error: "+e.message); }
 }
 
+async function bulkGenerate(){
+  const count = Number(el("bulkCount").value || 0);
+  if (!count){ toast("Вкажи кількість"); return; }
+  try{
+    const res = await jfetch("/admin_api/licenses/bulk/generate", "POST", {
+      count, prefix: el("bulkPrefix").value.trim(), credit: Number(el("bulkCredit").value || 0)
+    });
+    const a = document.createElement("a");
+    a.href = URL.createObjectURL(new Blob([res.keys.join("\n") + "\n"], { type: "text/plain" }));
+    a.download = `licenses_${res.created}.txt`;
+    a.click();
+    URL.revokeObjectURL(a.href);
+    toast("Створено: " + res.created);
+    await refresh(loadLicenses);
+  }catch(e){ toast("Bulk create error: "+e.message); }
+}
+
+async function bulkUpdate(change){
+  const q = el("licSearch").value.trim();
+  if (!confirm(q ? `Застосувати до всіх результатів пошуку "${q}"?` : "Застосувати до ВСІХ ліцензій?")) return;
+  try{
+    const res = await jfetch("/admin_api/licenses/bulk/update", "POST",
+                             Object.assign({ filter: q ? { q } : { all: true } }, change));
+    toast("Оновлено: " + res.updated);
+    await refresh(loadLicenses);
+  }catch(e){ toast("Bulk update error: "+e.message); }
+}
+
+function bulkCredit(){
+  const credit_delta = Number(el("bulkDelta").value || 0);
+  if (!credit_delta){ toast("Вкажи Δ балансу"); return; }
+  bulkUpdate({ credit_delta }).then(()=>{ el("bulkDelta").value = ""; });
+}
+
 // ================= API Keys =================
 let currentKeyEditId = null;
 
-async function loadApiKeys(){
+async function loadApiKeys(append=false){
+  const pg = pages.apikeys;
+  const url = pageUrl(pg, `/admin_api/apikeys`, append);
+  if (!url) return;
+  pg.loading = true;
   try{
-    const data = await jfetch(`/admin_api/apikeys`);
-    const tb = el("keysTbody");
-    tb.innerHTML = "";
-    data.forEach(row=>{
-      const tr = document.createElement("tr");
-      tr.innerHTML = `
+    const page = await jfetchPage(url);
+    pg.next = page.next;
+    if (!append) clearRows("apikey");
+    page.rows.forEach(row=>putRow("apikey", row));
+  }catch(e){ toast("Load apikeys error: "+e.message); }
+  finally{ pg.loading = false; }
+}
+
+function apiKeyRowHtml(row){
+  return `
         <td>${row.id}</td>
         <td><code class="copyable" onclick="copyToClipboard('${row.api_key.replace(/'/g, "\\'")}')">${row.api_key}</code></td>
         <td>${row.status}</td>
@@ -130,9 +226,6 @@ async function loadApiKeys(){
           <button class="btn btn-sm btn-outline-primary me-1" onclick='editApiKey(${row.id},"${row.api_key.replace(/"/g,'&quot;')}","${row.status}")'>✏️</button>
           <button class="btn btn-sm btn-outline-danger" onclick="deleteApiKey(${row.id})">🗑</button>
         </td>`;
-      tb.appendChild(tr);
-    });
-  }catch(e){ toast("Load apikeys error: "+e.message); }
 }
 
 function resetKeyForm(){
@@ -163,7 +256,7 @@ async function submitApiKey(){
       await jfetch(`/admin_api/apikeys`, "POST", payload);
     }
     resetKeyForm();
-    await loadApiKeys();
+    await refresh(loadApiKeys);
   }catch(e){ toast("Save apikey error: "+e.message); }
 }
 
@@ -171,21 +264,29 @@ async function deleteApiKey(id){
   if (!confirm("Видалити API ключ?")) return;
   try{
     await jfetch(`/admin_api/apikeys/${id}`, "DELETE");
-    await loadApiKeys();
+    await refresh(loadApiKeys);
   }catch(e){ toast("Delete key error: "+e.message); }
 }
 
 // ================= Voices =================
 let currentVoiceEditId = null;
 
-async function loadVoices(){
+async function loadVoices(append=false){
+  const pg = pages.voices;
+  const url = pageUrl(pg, `/admin_api/voices`, append);
+  if (!url) return;
+  pg.loading = true;
   try{
-    const data = await jfetch(`/admin_api/voices`);
-    const tb = el("voicesTbody");
-    tb.innerHTML = "";
-    data.forEach(row=>{
-      const tr = document.createElement("tr");
-      tr.innerHTML = `
+    const page = await jfetchPage(url);
+    pg.next = page.next;
+    if (!append) clearRows("voice");
+    page.rows.forEach(row=>putRow("voice", row));
+  }catch(e){ toast("Load voices error: "+e.message); }
+  finally{ pg.loading = false; }
+}
+
+function voiceRowHtml(row){
+  return `
         <td>${row.id}</td>
         <td>${row.name}</td>
         <td><code>${row.voice_id}</code></td>
@@ -194,9 +295,6 @@ async function loadVoices(){
           <button class="btn btn-sm btn-outline-primary me-1" onclick='editVoice(${row.id},"${row.name.replace(/"/g,'&quot;')}","${row.voice_id.replace(/"/g,'&quot;')}",${row.active})'>✏️</button>
           <button class="btn btn-sm btn-outline-danger" onclick="deleteVoice(${row.id})">🗑</button>
         </td>`;
-      tb.appendChild(tr);
-    });
-  }catch(e){ toast("Load voices error: "+e.message); }
 }
 
 function resetVoiceForm(){
@@ -231,18 +329,19 @@ async function submitVoice(){
       await jfetch(`/admin_api/voices`, "POST", payload);
     }
     resetVoiceForm();
-    await loadVoices();
+    await refresh(loadVoices);
   }catch(e){ toast("Save voice error: "+e.message); }
 }
 
 async function uploadVoices(){
   const fileInput = el("voiceFile");
   if (!fileInput.files.length){
-    toast("Оберіть файл .txt");
+    toast("Оберіть файл .txt / .csv / .json");
     return;
   }
   const formData = new FormData();
   formData.append("file", fileInput.files[0]);
+  if (el("voiceUpdateNames").checked) formData.append("update", "1");
   try{
     const res = await fetch("/admin_api/voices/upload", {
       method: "POST",
@@ -250,9 +349,9 @@ async function uploadVoices(){
     });
     const data = await res.json();
     if (!res.ok) throw new Error(data.msg || "Upload error");
-    toast(`Успішно додано ${data.added} голосів`);
+    toast(`Додано ${data.added}, оновлено ${data.updated}, пропущено ${data.skipped} голосів`);
     resetVoiceForm();
-    await loadVoices();
+    await refresh(loadVoices);
   }catch(e){
     toast("Upload voices error: "+e.message);
   }
@@ -262,30 +361,39 @@ async function deleteVoice(id){
   if (!confirm("Видалити голос?")) return;
   try{
     await jfetch(`/admin_api/voices/${id}`, "DELETE");
-    await loadVoices();
+    await refresh(loadVoices);
   }catch(e){ toast("Delete voice error: "+e.message); }
 }
 
 // ================= Activity Logs =================
-async function loadLogs(){
+function logFilterQuery(){
+  const q = encodeURIComponent(el("logSearch").value || "");
+  const minChars = el("logMinChars").value || "";
+  const maxChars = el("logMaxChars").value || "";
+  const action = el("logAction").value || "";
+  const dateFrom = el("logDateFrom").value || "";
+  const dateTo = el("logDateTo").value || "";
+  let qs = `q=${q}`;
+  if (minChars) qs += `&min_chars=${minChars}`;
+  if (maxChars) qs += `&max_chars=${maxChars}`;
+  if (action) qs += `&action=${action}`;
+  if (dateFrom) qs += `&date_from=${dateFrom}`;
+  if (dateTo) qs += `&date_to=${dateTo}`;
+  return qs;
+}
+
+async function loadLogs(append=false){
+  const pg = pages.logs;
+  if (append && (pg.loading || !pg.next)) return;
+  pg.loading = true;
   try{
-    const q = encodeURIComponent(el("logSearch").value || "");
-    const minChars = el("logMinChars").value || "";
-    const maxChars = el("logMaxChars").value || "";
-    const action = el("logAction").value || "";
-    const dateFrom = el("logDateFrom").value || "";
-    const dateTo = el("logDateTo").value || "";
-    let url = `/admin_api/logs?q=${q}`;
-    if (minChars) url += `&min_chars=${minChars}`;
-    if (maxChars) url += `&max_chars=${maxChars}`;
-    if (action) url += `&action=${action}`;
-    if (dateFrom) url += `&date_from=${dateFrom}`;
-    if (dateTo) url += `&date_to=${dateTo}`;
-    
-    const data = await jfetch(url);
+    let url = `/admin_api/logs?${logFilterQuery()}&limit=${PAGE_SIZE}`;
+    if (append) url += `&cursor=${encodeURIComponent(pg.next)}`;
+    const page = await jfetchPage(url);
+    pg.next = page.next;
     const tb = el("logsTbody");
-    tb.innerHTML = "";
-    data.forEach(row=>{
+    if (!append) tb.innerHTML = "";
+    page.rows.forEach(row=>{
       const tr = document.createElement("tr");
       tr.innerHTML = `
         <td>${row.id}</td>
@@ -297,6 +405,45 @@ async function loadLogs(){
       tb.appendChild(tr);
     });
   }catch(e){ toast("Load logs error: "+e.message); }
+  finally{ pg.loading = false; }
+}
+
+function exportLogs(fmt){
+  downloadStream(`/admin_api/logs/export?${logFilterQuery()}&format=${fmt}`);
+}
+
+// ================= Stats =================
+async function loadStats(){
+  try{
+    let url = `/admin_api/stats?granularity=${el("statsGran").value}&action=${el("statsAction").value}`;
+    if (el("statsFrom").value) url += `&date_from=${el("statsFrom").value}`;
+    if (el("statsTo").value) url += `&date_to=${el("statsTo").value}T23:59:59`;
+    const s = await jfetch(url);
+    el("statsTotals").innerHTML = Object.entries(s.totals).map(([a,t])=>
+      `<span class="badge text-bg-light border">${a}: ${t.chars} / ${t.count}</span>`).join("");
+    const max = Math.max(1, ...s.series.map(p=>p.chars));
+    const tb = el("statsSeries");
+    tb.innerHTML = "";
+    s.series.forEach(p=>{
+      const tr = document.createElement("tr");
+      tr.innerHTML = `
+        <td class="small">${new Date(p.bucket).toLocaleString()}</td>
+        <td>${p.chars}</td>
+        <td>${p.count}</td>
+        <td style="width:40%"><div class="stats-bar" style="width:${(100*p.chars/max).toFixed(1)}%"></div></td>`;
+      tb.appendChild(tr);
+    });
+    const top = el("statsTop");
+    top.innerHTML = "";
+    s.top.forEach(row=>{
+      const tr = document.createElement("tr");
+      tr.innerHTML = `
+        <td><code>${row.key || ("#"+row.license_id)}</code></td>
+        <td><strong>${row.chars}</strong></td>
+        <td>${row.count}</td>`;
+      top.appendChild(tr);
+    });
+  }catch(e){ toast("Load stats error: "+e.message); }
 }
 
 // ================= Config =================
@@ -326,36 +473,21 @@ async function saveConfig(){
   }catch(e){ toast("Save config error: "+e.message); }
 }
 
-async function downloadBackup(){
-  try{
-    const res = await fetch("/admin_api/backup");
-    if (!res.ok) throw new Error("Backup download failed");
-    const blob = await res.blob();
-    const url = window.URL.createObjectURL(blob);
-    const a = document.createElement("a");
-    a.href = url;
-    a.download = res.headers.get("Content-Disposition")?.split("filename=")[1] || "amulet_backup.json";
-    a.click();
-    window.URL.revokeObjectURL(url);
-  }catch(e){
-    toast("Backup error: "+e.message);
-  }
+// Backups are streamed by the server; let the browser write them straight
+// to disk instead of buffering the whole file into a Blob first.
+function downloadStream(url){
+  const a = document.createElement("a");
+  a.href = url;
+  a.download = "";
+  a.click();
 }
 
-async function downloadLicensesBackup(){
-  try{
-    const res = await fetch("/admin_api/backup/licenses");
-    if (!res.ok) throw new Error("Licenses backup download failed");
-    const blob = await res.blob();
-    const url = window.URL.createObjectURL(blob);
-    const a = document.createElement("a");
-    a.href = url;
-    a.download = res.headers.get("Content-Disposition")?.split("filename=")[1] || "amulet_licenses_backup.json";
-    a.click();
-    window.URL.revokeObjectURL(url);
-  }catch(e){
-    toast("Licenses backup error: "+e.message);
-  }
+function downloadBackup(){
+  downloadStream("/admin_api/backup?gzip=1");
+}
+
+function downloadLicensesBackup(){
+  downloadStream("/admin_api/backup/licenses");
 }
 
 // ================= API Console =================
@@ -377,7 +509,68 @@ async function runConsole(){
   }catch(e){ el("apiResult").textContent = "Error: "+e.message; }
 }
 
+// ================= Change feed =================
+// /admin_api/changes streams (entity, id, op, fields) events over SSE; they
+// are applied to the rendered rows instead of refetching whole tables.
+const feed = { last: null, live: false };
+
+// With the feed connected an edit comes back as an event; otherwise refetch.
+function refresh(load){ return feed.live ? Promise.resolve() : load(); }
+
+function applyChange(ev){
+  const t = tables[ev.entity];
+  if (!t) return;
+  if (ev.op === "reload"){ t.load(); return; }
+  if (ev.op === "delete"){
+    t.rows.delete(ev.id);
+    const tr = el(`${ev.entity}-${ev.id}`);
+    if (tr) tr.remove();
+    return;
+  }
+  if (ev.op === "create"){
+    if (!t.rows.has(ev.id) && t.acceptsNew()) putRow(ev.entity, ev.data, true);
+    return;
+  }
+  const row = t.rows.get(ev.id);
+  if (!row) return;
+  for (const k in ev.data) if (k in row) row[k] = ev.data[k];
+  const tr = putRow(ev.entity, row);
+  if (ev.op === "debit" || ev.op === "refund" || ev.op === "batch"){
+    // live usage: briefly highlight the row whose balance just moved
+    tr.classList.add(ev.op === "refund" ? "table-success" : "table-warning");
+    setTimeout(()=>tr.classList.remove("table-success", "table-warning"), 1500);
+  }
+}
+
+async function feedHead(){
+  if (!window.EventSource) return;
+  try{ feed.last = (await jfetch("/admin_api/changes")).last; }
+  catch(e){ feed.last = null; } // 404 when the server runs with CHANGE_FEED=0
+}
+
+function startFeed(){
+  if (feed.last === null) return;
+  const es = new EventSource(`/admin_api/changes?since=${feed.last}`);
+  es.onopen = ()=>{ feed.live = true; };
+  es.onerror = ()=>{ feed.live = false; }; // EventSource reconnects by itself
+  es.addEventListener("change", e=>applyChange(JSON.parse(e.data)));
+  es.addEventListener("reset", ()=>Object.values(tables).forEach(t=>t.load()));
+}
+
+// ---- infinite scroll: fetch the next page of the visible table ----
+window.addEventListener("scroll", ()=>{
+  if (window.innerHeight + window.scrollY < document.body.offsetHeight - 300) return;
+  const tab = document.querySelector(".tab-pane.active");
+  if (!tab) return;
+  if (tab.id === "tabLicenses") loadLicenses(true);
+  else if (tab.id === "tabApiKeys") loadApiKeys(true);
+  else if (tab.id === "tabVoices") loadVoices(true);
+  else if (tab.id === "tabLogs") loadLogs(true);
+});
+
 // ---- on load ----
 window.addEventListener("DOMContentLoaded", async ()=>{
+  await feedHead(); // before the first load, so no change can fall in between
   await Promise.all([loadLicenses(), loadApiKeys(), loadVoices(), loadConfig(), loadLogs()]);
+  startFeed();
 });
\ No newline at end of file
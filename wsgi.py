@@ -0,0 +1,7 @@
+"""Production WSGI entry point.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+See gunicorn.conf.py for the tunables and expected throughput.
+"""
+from app import app  # noqa: F401